@@ -0,0 +1,224 @@
+"""
+A persistent cache for printed results, so that reloading a document doesn't recompute every result.
+"""
+
+import hashlib
+import json
+import os
+from collections import OrderedDict
+
+import sympy
+
+from mathjson import mathjson_version
+
+# Stored results of another SymPy or printer version get thrown away
+result_cache_version = "sympy %s, mathjson %d" % (sympy.__version__, mathjson_version)
+
+
+def fingerprint(*parts):
+    """
+    A stable hash of JSON serializable parts, which doesn't depend on PYTHONHASHSEED or on the order of dictionary keys
+    """
+    text = json.dumps(parts, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class MemoryResultStore:
+    """
+    Maps fingerprints to printed results and evicts the least recently used ones once there are
+    more than max_entries of them or they take more than max_bytes characters.
+    """
+
+    def __init__(self, max_entries=10000, max_bytes=50_000_000, version=result_cache_version):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.version = version
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._bytes = 0
+
+    def get(self, key):
+        value = self._entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        if len(value) > self.max_bytes:
+            return
+        old_value = self._entries.pop(key, None)
+        if old_value is not None:
+            self._bytes -= len(old_value)
+        self._entries[key] = value
+        self._bytes += len(value)
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= len(evicted)
+
+    def clear(self):
+        self._entries.clear()
+        self._bytes = 0
+
+    def flush(self):
+        pass
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+        }
+
+
+class FileResultStore(MemoryResultStore):
+    """
+    A MemoryResultStore which keeps every result in its own file in the directory at path.
+    flush() only writes the results that were added since the last flush and deletes the evicted ones,
+    so that an IDBFS mount in Pyodide only has to synchronize those files with IndexedDB.
+
+    The results get loaded from the least to the most recently stored one, lookups don't change that order.
+    """
+
+    def __init__(self, path, max_entries=10000, max_bytes=50_000_000, version=result_cache_version):
+        super().__init__(max_entries, max_bytes, version)
+        self.path = path
+        # Keys that have a file
+        self._stored = set()
+        self._pending = set()
+        self._changed = False
+        os.makedirs(path, exist_ok=True)
+        version_path = os.path.join(path, "version")
+        try:
+            with open(version_path, encoding='utf-8') as file:
+                stored_version = file.read()
+        except OSError:
+            stored_version = None
+        names = [name for name in os.listdir(path) if name != "version" and not name.endswith('.tmp')]
+        if stored_version != version:
+            for name in names:
+                os.remove(os.path.join(path, name))
+            self._write(version_path, version)
+            return
+        stored = []
+        for name in names:
+            try:
+                with open(os.path.join(path, name), encoding='utf-8') as file:
+                    stored.append((os.stat(file.fileno()).st_mtime_ns, name, file.read()))
+            except OSError:
+                continue
+        for _, key, value in sorted(stored):
+            super().put(key, value)
+            self._stored.add(key)
+        # Deletes the files of results that didn't fit
+        self._changed = len(self._entries) != len(self._stored)
+
+    def put(self, key, value):
+        super().put(key, value)
+        self._pending.add(key)
+        self._changed = True
+
+    def clear(self):
+        super().clear()
+        self._pending.clear()
+        self._changed = True
+
+    def flush(self):
+        if not self._changed:
+            return
+        for key in self._stored - self._entries.keys():
+            try:
+                os.remove(os.path.join(self.path, key))
+            except FileNotFoundError:
+                pass
+            self._stored.discard(key)
+        for key in self._pending & self._entries.keys():
+            self._write(os.path.join(self.path, key), self._entries[key])
+            self._stored.add(key)
+        self._pending.clear()
+        self._changed = False
+
+    def _write(self, path, text):
+        temporary_path = path + '.tmp'
+        with open(temporary_path, 'w', encoding='utf-8') as file:
+            file.write(text)
+        os.replace(temporary_path, path)
+
+
+class SqliteResultStore:
+    """
+    Like MemoryResultStore, but stored in a SQLite database, which doesn't have to be loaded into memory
+    """
+
+    def __init__(self, path, max_entries=10000, max_bytes=50_000_000, version=result_cache_version):
+        import sqlite3
+
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.version = version
+        self.hits = 0
+        self.misses = 0
+        self._connection = sqlite3.connect(path)
+        with self._connection:
+            self._connection.execute("CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT)")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value TEXT, size INTEGER, used INTEGER)"
+            )
+            self._connection.execute("CREATE INDEX IF NOT EXISTS results_used ON results (used)")
+            row = self._connection.execute("SELECT value FROM metadata WHERE name = 'version'").fetchone()
+            if row is None or row[0] != version:
+                self._connection.execute("DELETE FROM results")
+                self._connection.execute("INSERT OR REPLACE INTO metadata VALUES ('version', ?)", (version,))
+        # Increases with every access, so that the least recently used results have the lowest values
+        self._clock = self._connection.execute("SELECT COALESCE(MAX(used), 0) FROM results").fetchone()[0]
+
+    def get(self, key):
+        row = self._connection.execute("SELECT value FROM results WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._clock += 1
+        with self._connection:
+            self._connection.execute("UPDATE results SET used = ? WHERE key = ?", (self._clock, key))
+        return row[0]
+
+    def put(self, key, value):
+        if len(value) > self.max_bytes:
+            return
+        self._clock += 1
+        with self._connection:
+            self._connection.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)", (key, value, len(value), self._clock))
+            count, size = self._connection.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM results").fetchone()
+            if count > self.max_entries or size > self.max_bytes:
+                self._evict(count, size)
+
+    def _evict(self, count, size):
+        evicted = []
+        for key, entry_size in self._connection.execute("SELECT key, size FROM results ORDER BY used"):
+            if count <= self.max_entries and size <= self.max_bytes:
+                break
+            evicted.append((key,))
+            count -= 1
+            size -= entry_size
+        self._connection.executemany("DELETE FROM results WHERE key = ?", evicted)
+
+    def clear(self):
+        with self._connection:
+            self._connection.execute("DELETE FROM results")
+
+    def flush(self):
+        self._connection.commit()
+
+    def stats(self):
+        count, size = self._connection.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM results").fetchone()
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": count,
+            "bytes": size,
+        }
@@ -0,0 +1,94 @@
+"""
+Cooperative cancellation, so that a single slow command doesn't block every command after it.
+"""
+
+import sys
+import time
+
+
+class Cancelled(BaseException):
+    """
+    Raised when a command got cancelled, the reason is either "cancelled" or "timeout".
+    Like KeyboardInterrupt, it's not an Exception, so that SymPy's except Exception blocks don't swallow it.
+    """
+
+    def __init__(self, reason):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class Cancellation:
+    """
+    The deadline and the cancellation flag of the command that is currently running.
+
+    Loops which run once per node, like the printer traversal, call tick(), which only looks
+    at the clock every interval calls. Between the stages of a command, check() gets called directly.
+    Neither can stop SymPy in the middle of an operation. In Pyodide, the main thread can do that
+    with an interrupt buffer (see pyodide.setInterruptBuffer), which raises a KeyboardInterrupt.
+    run() turns that into a cancellation as well.
+
+    Interrupt buffers need a cross origin isolated page. Without one, preemptive cancellations let
+    call() tick on every Python function call, so that a deadline stops SymPy in the middle of an
+    operation too. That roughly doubles the time SymPy takes, so it's off by default.
+    """
+
+    def __init__(self, interval=1000, preemptive=False):
+        self.interval = interval
+        self.preemptive = preemptive
+        self.cancelled = False
+        self.deadline = None
+        self._countdown = interval
+
+    def start(self, timeout=None):
+        self.cancelled = False
+        self.deadline = None if timeout is None else time.monotonic() + timeout
+        self._countdown = self.interval
+
+    def cancel(self):
+        self.cancelled = True
+
+    def check(self):
+        if self.cancelled:
+            raise Cancelled("cancelled")
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            raise Cancelled("timeout")
+
+    def tick(self):
+        self._countdown -= 1
+        if self._countdown <= 0:
+            self._countdown = self.interval
+            self.check()
+
+    def call(self, function, *args):
+        """
+        Calls a function which can take a long time, e.g. a SymPy operation. Preemptive cancellations check the deadline while it runs.
+        """
+        if not self.preemptive or self.deadline is None:
+            return function(*args)
+        previous_profile = sys.getprofile()
+
+        def on_call(frame, event, arg):
+            # Raising here also removes the profile function
+            if previous_profile is not None:
+                previous_profile(frame, event, arg)
+            if event == "call":
+                self.tick()
+
+        sys.setprofile(on_call)
+        try:
+            return function(*args)
+        finally:
+            sys.setprofile(previous_profile)
+
+    def run(self, function, *args, timeout=None):
+        """
+        Calls function with a new deadline, timeout is in seconds. Raises Cancelled if it got cancelled.
+        """
+        self.start(timeout)
+        try:
+            return function(*args)
+        except KeyboardInterrupt:
+            raise Cancelled("cancelled") from None
+        finally:
+            self.cancelled = False
+            self.deadline = None
@@ -0,0 +1,97 @@
+"""
+Executes CAS commands, which arrive as MathJson and get printed back to MathJson.
+"""
+
+import json
+
+import sympy
+
+from mathjson import MathJsonTreePrinter, print_cache, order_cache, name_table
+from mathjson_builder import MathJsonBuilder
+from cas_substitution import substituter
+from cas_solver import solver, NumericRoots
+
+_printer_settings = {
+    "print_cache": print_cache,
+    # Mostly for the stream writer, which prints subtrees without the print cache
+    "order_cache": order_cache,
+    # Results arrive with decoded names, so that Javascript doesn't have to walk them again
+    "name_table": name_table,
+    "iterative": True,
+}
+
+
+def _solve(expr, builder, argument):
+    solutions, strategy = solver.solve(expr, builder.symbol(argument))
+    if strategy == "numeric":
+        return NumericRoots(*solutions)
+    return solutions
+
+
+def _rewrite(expr, builder, argument):
+    if argument:
+        return expr.rewrite(builder.function(argument))
+    return expr.rewrite()
+
+
+# Every operation gets the expression after the substitutions
+_operations = {
+    "evalf": lambda expr, builder, argument: expr.evalf(),
+    "simplify": lambda expr, builder, argument: sympy.simplify(expr),
+    "expand": lambda expr, builder, argument: sympy.expand(expr),
+    "factor": lambda expr, builder, argument: sympy.factor(expr),
+    "solve": _solve,
+    "rewrite": _rewrite,
+}
+
+
+def _evaluate(command, builder):
+    operation = _operations.get(command["operation"])
+    if operation is None:
+        raise ValueError("Unknown operation %s" % command["operation"])
+
+    expr = builder.build(command["expression"])
+    substitutions = {
+        builder.symbol(name): builder.build(value)
+        for name, value in command.get("substitutions", {}).items()
+    }
+    expr, _ = substituter.substitute(expr, substitutions)
+    return operation(expr, builder, command.get("argument"))
+
+
+def execute(command):
+    """
+    Executes a single command and returns its result as a MathJson string.
+
+    A command is a dictionary with
+    - expression: The MathJson expression
+    - substitutions: Maps symbol names to their MathJson values
+    - operation: One of the _operations, e.g. "evalf" or "solve"
+    - argument: An optional argument for the operation, e.g. the variable to solve for
+    """
+    return MathJsonTreePrinter(_printer_settings).doprint(_evaluate(command, MathJsonBuilder()))
+
+
+def execute_batch(commands):
+    """
+    Executes many commands at once, sharing one builder and one printer.
+    Returns either {"result": MathJson} or {"error": message} for every command.
+    """
+    builder = MathJsonBuilder()
+    printer = MathJsonTreePrinter(_printer_settings)
+    results = []
+    for command in commands:
+        try:
+            results.append({"result": printer.totree(_evaluate(command, builder))})
+        except Exception as e:
+            results.append({"error": "%s: %s" % (type(e).__name__, e)})
+    return results
+
+
+def execute_json(command_json):
+    return execute(json.loads(command_json))
+
+
+def execute_batch_json(commands_json):
+    # Serialized exactly once, for the whole batch
+    return MathJsonTreePrinter(_printer_settings).dumps(execute_batch(json.loads(commands_json)))
@@ -0,0 +1,206 @@
+"""
+Numeric evaluation of expressions, which compiles every expression once and then only calls it with new values.
+"""
+
+import math
+from array import array
+from collections import OrderedDict
+
+import mpmath
+from sympy.core import S, Float, Add, Mul
+from sympy.utilities.lambdify import lambdify
+
+
+def _to_python_number(value):
+    try:
+        return float(value)
+    except TypeError:
+        return complex(value)
+
+
+def _linspace(start, stop, count):
+    if count < 1:
+        raise ValueError("Expected at least one point")
+    if count == 1:
+        return [start]
+    step = (stop - start) / (count - 1)
+    return [start + i * step for i in range(count)]
+
+
+class NumericEngine:
+    """
+    Evaluates expressions numerically, like expr.subs(values).evalf(), without the symbolic substitution.
+
+    Compiled functions are cached by the structure of the expression and its symbols, so changing
+    the value of a symbol doesn't compile anything.
+    - "mpmath" mode evaluates at the requested precision plus some guard digits
+    - "float64" mode uses Python floats, which is faster but can lose digits, e.g. to cancellation
+    """
+
+    def __init__(self, mode="mpmath", guard_digits=10, max_entries=256):
+        if mode not in ("mpmath", "float64"):
+            raise ValueError("Unknown mode %s" % mode)
+        self.mode = mode
+        self.guard_digits = guard_digits
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._functions = OrderedDict()
+
+    def evaluate(self, expr, values, dps=15):
+        """
+        Returns a SymPy number, or None if the expression cannot be evaluated numerically with those values.
+        """
+        if not expr.free_symbols <= values.keys() or expr.has(S.ComplexInfinity, S.NaN):
+            return None
+        symbols = tuple(sorted(expr.free_symbols, key=lambda symbol: symbol.name))
+        try:
+            function = self._compile(expr, symbols)
+            if self.mode == "float64":
+                result = function(*[_to_python_number(values[symbol]) for symbol in symbols])
+            else:
+                result = self._evaluate_mpmath(function, [values[symbol] for symbol in symbols], dps)
+        except (ArithmeticError, ValueError, TypeError, NameError):
+            # e.g. a division by zero, a function which is only defined for complex numbers or an undefined function
+            return None
+        if result is None or not mpmath.isfinite(result):
+            # At poles, e.g. log(0), the symbolic evaluation knows better whether that's oo, -oo or zoo
+            return None
+        return self._to_sympy(result, dps)
+
+    def evaluate_grid(self, expr, sweeps, values):
+        """
+        Evaluates an expression over a 1D or 2D grid, using NumPy if it's available.
+
+        sweeps is a list of (symbol, start, stop, count), every other symbol needs a value.
+        Returns the shape and the row-major float64 data, which has NaN wherever the result isn't a real number.
+        """
+        if not 1 <= len(sweeps) <= 2:
+            raise ValueError("Expected one or two variables to sweep over")
+        swept_symbols = tuple(sweep[0] for sweep in sweeps)
+        fixed_symbols = tuple(sorted(expr.free_symbols - set(swept_symbols), key=lambda symbol: symbol.name))
+        missing = [symbol.name for symbol in fixed_symbols if symbol not in values]
+        if missing:
+            raise ValueError("Missing values for %s" % ", ".join(missing))
+        symbols = swept_symbols + fixed_symbols
+        fixed_values = [_to_python_number(values[symbol]) for symbol in fixed_symbols]
+        shape = [int(sweep[3]) for sweep in sweeps]
+        axes = [_linspace(float(start), float(stop), int(count)) for _, start, stop, count in sweeps]
+
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+
+        if numpy is None:
+            data = array('d', [math.nan]) * math.prod(shape)
+            missing_points = range(len(data))
+        else:
+            grid = numpy.meshgrid(*[numpy.array(axis) for axis in axes], indexing='ij')
+            function = None
+            try:
+                function = self._compile(expr, symbols, "numpy")
+                with numpy.errstate(all='ignore'):
+                    result = numpy.asarray(function(*grid, *fixed_values))
+                result = numpy.broadcast_to(result, shape)
+                if numpy.iscomplexobj(result):
+                    result = numpy.where(result.imag == 0, result.real, numpy.nan)
+                data = numpy.array(result, dtype=numpy.float64).ravel()
+            except (ArithmeticError, ValueError, TypeError, NameError):
+                function = None
+                data = numpy.full(math.prod(shape), numpy.nan)
+            missing_points = numpy.flatnonzero(numpy.isnan(data))
+            if len(missing_points) > 0 and function is not None:
+                missing_points = self._drop_complex_points(numpy, function, grid, fixed_values, missing_points)
+
+        if len(missing_points) > 0:
+            # mpmath for whatever NumPy couldn't evaluate, e.g. functions NumPy doesn't know or overflows
+            self._evaluate_points_mpmath(expr, symbols, axes, fixed_values, shape, data, missing_points)
+        return shape, data
+
+    def _drop_complex_points(self, numpy, function, grid, fixed_values, points):
+        """
+        Evaluates the points again with complex inputs. The ones with a complex value, e.g. sqrt(x) for x < 0,
+        are legitimately not real and stay NaN. Only the rest, e.g. overflows, are left for mpmath.
+        """
+        try:
+            with numpy.errstate(all='ignore'):
+                values = function(*[axis.ravel()[points].astype(complex) for axis in grid], *[complex(value) for value in fixed_values])
+                values = numpy.broadcast_to(numpy.asarray(values, dtype=complex), points.shape)
+        except (ArithmeticError, ValueError, TypeError, NameError):
+            # e.g. functions which only take real numbers
+            return points
+        return points[~(numpy.isfinite(values) & (values.imag != 0))]
+
+    def _evaluate_points_mpmath(self, expr, symbols, axes, fixed_values, shape, data, points):
+        try:
+            function = self._compile(expr, symbols, "mpmath")
+        except (NameError, TypeError):
+            return
+        columns = shape[1] if len(shape) == 2 else 1
+        for point in points:
+            point = int(point)
+            swept_values = [axes[0][point // columns]] + ([axes[1][point % columns]] if len(shape) == 2 else [])
+            try:
+                value = mpmath.mpmathify(function(*swept_values, *fixed_values))
+            except (ArithmeticError, ValueError, TypeError, NameError):
+                continue
+            if isinstance(value, mpmath.mpc):
+                if value.imag != 0:
+                    continue
+                value = value.real
+            data[point] = float(value)
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": len(self._functions),
+        }
+
+    def _evaluate_mpmath(self, function, values, dps):
+        """
+        Evaluates at two different precisions. Unlike evalf, mpmath doesn't track how many digits are correct,
+        so the result only gets used if both agree, e.g. no digits were lost to cancellation.
+        """
+        results = []
+        for digits in (dps + self.guard_digits, dps + 2 * self.guard_digits):
+            prec = mpmath.libmp.dps_to_prec(digits)
+            with mpmath.workprec(prec):
+                results.append(function(*[value._to_mpmath(prec) for value in values]))
+        low, high = results
+        with mpmath.workdps(dps + 2 * self.guard_digits):
+            if abs(high - low) > abs(high) * mpmath.mpf(10) ** -(dps + 1):
+                return None
+        return high
+
+    def _compile(self, expr, symbols, modules=None):
+        if modules is None:
+            modules = "math" if self.mode == "float64" else "mpmath"
+        key = (expr, symbols, modules)
+        function = self._functions.get(key)
+        if function is not None:
+            self.hits += 1
+            self._functions.move_to_end(key)
+            return function
+
+        self.misses += 1
+        function = lambdify(symbols, expr, modules=modules)
+        self._functions[key] = function
+        while len(self._functions) > self.max_entries:
+            self._functions.popitem(last=False)
+        return function
+
+    def _to_sympy(self, value, dps):
+        if isinstance(value, (complex, mpmath.mpc)):
+            real, imag = Float(value.real, dps), Float(value.imag, dps)
+            if imag == 0:
+                return real
+            return Add(real, Mul(imag, S.ImaginaryUnit))
+        if isinstance(value, (int, float, mpmath.mpf)):
+            return Float(value, dps)
+        return None
+
+
+# Shared by the whole worker session
+numeric_engine = NumericEngine()
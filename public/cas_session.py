@@ -0,0 +1,335 @@
+"""
+A persistent evaluation session, which only recomputes results when the definitions that they depend on have new values.
+"""
+
+import json
+from collections import OrderedDict
+
+from sympy.core import Symbol
+
+from mathjson import MathJsonStreamWriter, MathJsonTreePrinter, _shared_size
+from cas_cache import fingerprint, FileResultStore
+from cas_cancellation import Cancellation, Cancelled
+from mathjson_builder import MathJsonBuilder
+from cas_commands import _operations, _printer_settings
+from cas_numeric import numeric_engine
+from cas_solver import solver
+from cas_substitution import substituter
+
+
+class _Result:
+    __slots__ = ("dependencies", "value", "expr")
+
+    def __init__(self, dependencies, value, expr=None):
+        # Maps every name that the value depends on to the version of its definition, or None if it was undefined
+        self.dependencies = dependencies
+        self.value = value
+        # Only kept for results with placeholders, whose contents can still be fetched
+        self.expr = expr
+
+
+class CasSession:
+    """
+    Holds named definitions and the printed results of commands that use them.
+
+    The version of a definition is its canonical MathJson value, so defining a name again with an
+    earlier value brings back the earlier version. Results and resolved definitions remember the
+    versions they were computed with, and every command or name keeps up to max_variants of them.
+    That way, commands which use the same name with different values, e.g. in different parts
+    of a sheet, don't recompute each other's results. Results whose versions match the current
+    definitions are returned without building, substituting or printing anything.
+
+    Results with more than max_nodes nodes or max_bytes bytes get written with placeholders, see MathJsonStreamWriter.
+    Commands with "shared": true print repeated subtrees only once, see MathJsonPrinter's "shared_subtrees".
+    If that's still over budget, they get written with placeholders like every other command.
+    Commands in a batch can be cancelled and have a timeout in seconds, which defaults to timeout.
+
+    Results without placeholders also go into the result_store, e.g. a cas_cache.FileResultStore, which outlives the session.
+    They are stored under a fingerprint of the command and of the definitions that it uses.
+    """
+
+    def __init__(self, max_results=1000, max_variants=8, max_nodes=50000, max_bytes=None, timeout=None, result_store=None):
+        self.max_results = max_results
+        self.max_variants = max_variants
+        self.timeout = timeout
+        self.result_store = result_store
+        self.cancellation = Cancellation()
+        self.hits = 0
+        self.misses = 0
+        self._builder = MathJsonBuilder()
+        self._writer = MathJsonStreamWriter(
+            dict(_printer_settings, cancellation=self.cancellation), max_nodes=max_nodes, max_bytes=max_bytes)
+        self._shared_printer = MathJsonTreePrinter(dict(_printer_settings, cancellation=self.cancellation, shared_subtrees=True))
+        # name -> (version, SymPy expression)
+        self._definitions = dict()
+        # (name, version) -> SymPy expression, so that switching back to an earlier value doesn't build it again
+        self._built = OrderedDict()
+        # name -> _Results with the definition after substituting its dependencies
+        self._resolved = dict()
+        # command key -> _Results, most recently used last
+        self._results = OrderedDict()
+
+    def define(self, name, value):
+        """
+        Defines or redefines a name. Returns True if the definition changed.
+        """
+        version = json.dumps(value, sort_keys=True, separators=(',', ':'))
+        definition = self._definitions.get(name)
+        if definition is not None and definition[0] == version:
+            return False
+        expr = self._built.get((name, version))
+        if expr is None:
+            expr = self._builder.build(value)
+        self._built[(name, version)] = expr
+        self._built.move_to_end((name, version))
+        while len(self._built) > self.max_results:
+            self._built.popitem(last=False)
+        self._definitions[name] = (version, expr)
+        return True
+
+    def undefine(self, name):
+        self._definitions.pop(name, None)
+
+    def execute(self, command):
+        """
+        Executes a command (see cas_commands.execute) and returns its result as a MathJson string.
+        The substitutions of the command become definitions of the session. Names which aren't
+        in the substitutions stay undefined for this command, like with a plain .subs()
+        """
+        substitutions = command.get("substitutions", {})
+        for name, value in substitutions.items():
+            self.define(name, value)
+        return self.evaluate(command, visible=substitutions.keys())
+
+    def evaluate(self, command, visible=None):
+        """
+        Evaluates a command using the definitions of the session, ignoring its substitutions.
+        If visible is set, only the definitions with those names get used.
+        """
+        key = self._key(command)
+        result = self._find(self._results.get(key), visible)
+        if result is not None:
+            self.hits += 1
+            self._results.move_to_end(key)
+            return result.value
+
+        self.misses += 1
+        operation = _operations.get(command["operation"])
+        if operation is None:
+            raise ValueError("Unknown operation %s" % command["operation"])
+
+        expr = self._builder.build(command["expression"])
+        dependencies = dict()
+        substitutions = self._resolve_symbols(expr, visible, dependencies, ())
+        stored_key = None
+        if self.result_store is not None:
+            stored_key = self._fingerprint(key, dependencies)
+            text = self.result_store.get(stored_key)
+            if text is not None:
+                self._store(key, _Result(dependencies, text))
+                return text
+        self.cancellation.check()
+        result = None
+        if command["operation"] == "evalf" and all(value.is_number for value in substitutions.values()):
+            # Only the values changed, so the compiled expression can be reused
+            result = numeric_engine.evaluate(expr, substitutions)
+        if result is None and command["operation"] == "evalf":
+            result, _ = substituter.evalf(expr, substitutions)
+        elif result is None:
+            expr, _ = substituter.substitute(expr, substitutions)
+            self.cancellation.check()
+            result = self.cancellation.call(operation, expr, self._builder, command.get("argument"))
+        self.cancellation.check()
+        if command.get("shared"):
+            text, elided = self._print_shared(result)
+        else:
+            text, elided = self._writer.dumps(result), self._writer.elided
+
+        self._store(key, _Result(dependencies, text, result if elided else None))
+        if stored_key is not None and not elided:
+            self.result_store.put(stored_key, text)
+        return text
+
+    def _print_shared(self, result):
+        """
+        Prints result with shared subtrees if the definitions and the body together fit into max_nodes and max_bytes.
+        Otherwise, it gets written with placeholders, unless the writer doesn't leave anything out after all.
+        Returns the text and the number of placeholders.
+        """
+        max_nodes, max_bytes = self._writer.max_nodes, self._writer.max_bytes
+        shared_text = None
+        if max_nodes is None or _shared_size(result, self._shared_printer._settings["min_shared_size"]) <= max_nodes:
+            shared_text = self._shared_printer.doprint(result)
+            if max_bytes is None or len(shared_text) <= max_bytes:
+                return shared_text, 0
+        text = self._writer.dumps(result)
+        if self._writer.elided:
+            return text, self._writer.elided
+        if shared_text is None:
+            shared_text = self._shared_printer.doprint(result)
+        return min(text, shared_text, key=len), 0
+
+    def _store(self, key, result):
+        self._add_variant(self._results.setdefault(key, []), result)
+        self._results.move_to_end(key)
+        while len(self._results) > self.max_results:
+            self._results.popitem(last=False)
+
+    def _find(self, variants, visible):
+        """
+        The variant whose versions match the visible definitions, or None
+        """
+        for i, result in enumerate(variants or ()):
+            if self._is_valid(result, visible):
+                if i:
+                    # Most recently used first
+                    variants.insert(0, variants.pop(i))
+                return result
+        return None
+
+    def _add_variant(self, variants, result):
+        variants.insert(0, result)
+        del variants[self.max_variants:]
+
+    def fetch(self, command, path, index=None):
+        """
+        Writes the contents of a placeholder in the result of a command, see MathJsonStreamWriter.fetch.
+        The command gets executed again if its result is no longer around.
+        """
+        key = self._key(command)
+        visible = command.get("substitutions", {}).keys()
+        result = self._find(self._results.get(key), visible)
+        if result is None:
+            self.execute(command)
+            result = self._find(self._results.get(key), visible)
+        if result is None or result.expr is None:
+            raise ValueError("The result doesn't have any placeholders")
+        return self._writer.fetch(result.expr, path, index)
+
+    def execute_batch(self, commands):
+        """
+        Like cas_commands.execute_batch, except that it reuses the results of earlier commands
+        and that the results are MathJson strings.
+        A command which got cancelled or took longer than its "timeout" returns {"cancelled": "cancelled" or "timeout"}.
+        """
+        results = [self.execute_batch_command(command) for command in commands]
+        self.flush()
+        return results
+
+    def execute_batch_command(self, command):
+        """
+        Executes one command of a batch, and returns {"result": MathJson}, {"error": message} or {"cancelled": reason}
+        """
+        try:
+            return {"result": self.cancellation.run(self.execute, command, timeout=command.get("timeout", self.timeout))}
+        except Cancelled as e:
+            return {"cancelled": e.reason}
+        except Exception as e:
+            return {"error": "%s: %s" % (type(e).__name__, e)}
+
+    def flush(self):
+        """
+        Writes the new results to the result_store, once per batch
+        """
+        if self.result_store is not None:
+            self.result_store.flush()
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "definitions": len(self._definitions),
+            "results": len(self._results),
+            "substitutions": substituter.stats(),
+            "solver": solver.stats(),
+            "result_store": self.result_store.stats() if self.result_store is not None else None,
+        }
+
+    def _key(self, command):
+        return json.dumps(
+            [command["expression"], command["operation"], command.get("argument"), command.get("shared", False)],
+            sort_keys=True, separators=(',', ':')
+        )
+
+    def _fingerprint(self, key, dependencies):
+        """
+        The versions are canonical MathJson, so the fingerprint stays the same across sessions
+        """
+        return fingerprint(key, sorted(dependencies.items()), self._writer.max_nodes, self._writer.max_bytes)
+
+    def _visible_version(self, name, visible):
+        if visible is not None and name not in visible:
+            return None
+        definition = self._definitions.get(name)
+        return definition[0] if definition is not None else None
+
+    def _is_valid(self, result, visible):
+        return all(
+            self._visible_version(name, visible) == version
+            for name, version in result.dependencies.items()
+        )
+
+    def _resolve_symbols(self, expr, visible, dependencies, resolving):
+        """
+        Resolves the values of all symbols in expr and records the versions that were used.
+        Names which are currently being resolved are left as they are, so a definition like x = x + 1
+        doesn't recurse forever.
+        """
+        substitutions = dict()
+        for symbol in expr.free_symbols:
+            if not isinstance(symbol, Symbol):
+                continue
+            name = symbol.name
+            version = self._visible_version(name, visible)
+            dependencies[name] = version
+            if version is not None and name not in resolving:
+                substitutions[symbol] = self._resolve(name, visible, dependencies, resolving)
+        return substitutions
+
+    def _resolve(self, name, visible, dependencies, resolving):
+        variants = self._resolved.setdefault(name, [])
+        resolved = self._find(variants, visible)
+        if resolved is None:
+            version, expr = self._definitions[name]
+            resolved_dependencies = {name: version}
+            substitutions = self._resolve_symbols(expr, visible, resolved_dependencies, resolving + (name,))
+            if substitutions:
+                expr, _ = substituter.substitute(expr, substitutions)
+                self.cancellation.check()
+            resolved = _Result(resolved_dependencies, expr)
+            self._add_variant(variants, resolved)
+        dependencies.update(resolved.dependencies)
+        return resolved.value
+
+
+# Lives as long as the worker. Commands without a "timeout" get cancelled after a minute
+session = CasSession(timeout=60)
+
+
+def execute_session_command_json(command_json):
+    """
+    Executes one command of a batch, so that Javascript can skip cancelled commands in between.
+    Call flush_session after the batch.
+    """
+    result = session.execute_batch_command(json.loads(command_json))
+    # The results are already MathJson strings
+    return '{"result":%s}' % result["result"] if "result" in result else json.dumps(result, separators=(',', ':'))
+
+
+def flush_session():
+    session.flush()
+
+
+def fetch_json(request_json):
+    """
+    Takes a command, the path of a placeholder and optionally its index, and returns the placeholder's contents
+    """
+    request = json.loads(request_json)
+    return session.cancellation.run(session.fetch, request["command"], request["path"], request.get("index"), timeout=session.timeout)
+
+
+def open_result_store(path):
+    """
+    Keeps the results of the session in a directory, which Javascript can put on an IDBFS mount
+    """
+    session.result_store = FileResultStore(path)
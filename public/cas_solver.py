@@ -0,0 +1,181 @@
+"""
+Solves an equation for one symbol with the cheapest strategy that applies, and numerically if solving it symbolically takes too long.
+"""
+
+import signal
+import sys
+import threading
+import time
+from collections import Counter
+
+from sympy.core import Eq, Float, S, Tuple
+from sympy.polys.polyroots import roots
+from sympy.polys.polytools import Poly
+from sympy.polys.polyerrors import PolynomialError
+from sympy.solvers import solve, nsolve
+from sympy.solvers.solveset import linsolve
+from sympy.utilities import default_sort_key
+
+# Tried one after the other by the numeric fallback
+_real_starting_points = (0, 1, -1, 10, -10)
+# Only for equations which aren't real, since they'd find complex roots of real equations, e.g. I for Abs(x) - 1
+_complex_starting_points = (1j, -1j)
+
+
+class _OverBudget(BaseException):
+    """
+    Not an Exception, so that SymPy's except Exception blocks don't swallow it
+    """
+
+
+class NumericRoots(Tuple):
+    """
+    The roots that the numeric fallback found, there can be others.
+    Printed as ["NumericRoots", ...roots] instead of as a list, which would look like all of them.
+    """
+
+    def _mathjson(self, printer):
+        return printer._function("NumericRoots", [printer._print(root) for root in self.args])
+
+
+class Solver:
+    """
+    Picks a strategy for every equation, which is an Eq or an expression that is equal to zero
+    - "linear" uses linsolve for equations of degree 1 in the symbol
+    - "polynomial" uses roots, as long as it finds all roots of a polynomial
+    - "symbolic" is the generic solve(), which only gets budget seconds
+    - "numeric" finds roots with nsolve when "symbolic" ran out of time or failed. Only works if the symbol is the only free symbol,
+      and only returns the roots that it happens to find from a few starting points
+
+    Symbols with assumptions, e.g. positive=True, always go to solve(), which discards the roots that don't fit them.
+    counts records how often every strategy got used.
+    """
+
+    def __init__(self, budget=5.0, dps=15):
+        self.budget = budget
+        self.dps = dps
+        self.counts = Counter()
+
+    def solve(self, expr, symbol):
+        """
+        Returns the list of solutions, like solve(expr, symbol), and the strategy that was used
+        """
+        if isinstance(expr, Eq):
+            expr = expr.lhs - expr.rhs
+        solutions, strategy = None, None
+        if symbol in expr.free_symbols and self._has_no_assumptions(symbol):
+            solutions, strategy = self._solve_polynomial(expr, symbol)
+        if solutions is None:
+            try:
+                solutions, strategy = self._with_budget(solve, expr, symbol), "symbolic"
+            except _OverBudget:
+                reason = "within %s seconds" % self.budget
+            except NotImplementedError:
+                reason = "symbolically"
+            if solutions is None:
+                if expr.free_symbols != {symbol}:
+                    raise ValueError("Could not solve for %s %s" % (symbol, reason))
+                solutions, strategy = self._solve_numeric(expr, symbol), "numeric"
+        self.counts[strategy] += 1
+        return solutions, strategy
+
+    def stats(self):
+        return dict(self.counts)
+
+    def _has_no_assumptions(self, symbol):
+        return all(key == "commutative" for key in symbol.assumptions0)
+
+    def _solve_polynomial(self, expr, symbol):
+        try:
+            polynomial = Poly(expr, symbol)
+        except PolynomialError:
+            return None, None
+        degree = polynomial.degree()
+        if degree < 1:
+            return None, None
+        if degree == 1:
+            solutions = linsolve([expr], [symbol])
+            return [solution[0] for solution in solutions], "linear"
+        found = roots(polynomial)
+        if sum(found.values()) != degree:
+            # e.g. a quintic, solve() returns CRootOfs
+            return None, None
+        # In the same order as solve() returns them
+        return sorted(found, key=default_sort_key), "polynomial"
+
+    def _with_budget(self, function, *args):
+        """
+        Calls function and raises _OverBudget once it takes longer than the budget.
+        Uses a timer signal where possible, and a profile function that looks at the clock otherwise, e.g. in Pyodide.
+        """
+        if self.budget is None:
+            return function(*args)
+        if hasattr(signal, "setitimer") and sys.platform != "emscripten" and threading.current_thread() is threading.main_thread():
+            def on_alarm(signum, frame):
+                raise _OverBudget()
+
+            previous_handler = signal.signal(signal.SIGALRM, on_alarm)
+            signal.setitimer(signal.ITIMER_REAL, self.budget)
+            try:
+                return function(*args)
+            finally:
+                signal.setitimer(signal.ITIMER_REAL, 0)
+                signal.signal(signal.SIGALRM, previous_handler)
+
+        deadline = time.monotonic() + self.budget
+        countdown = [1000]
+        # e.g. the one of a preemptive cas_cancellation.Cancellation, which has to keep working
+        previous_profile = sys.getprofile()
+
+        def on_call(frame, event, arg):
+            # Raising here also removes the profile function
+            if previous_profile is not None:
+                previous_profile(frame, event, arg)
+            if event == "call":
+                countdown[0] -= 1
+                if countdown[0] <= 0:
+                    countdown[0] = 1000
+                    if time.monotonic() > deadline:
+                        raise _OverBudget()
+
+        sys.setprofile(on_call)
+        try:
+            return function(*args)
+        finally:
+            sys.setprofile(previous_profile)
+
+    def _solve_numeric(self, expr, symbol):
+        tolerance = Float(10) ** (2 - self.dps)
+        is_real = not expr.has(S.ImaginaryUnit)
+        starting_points = _real_starting_points if is_real else _real_starting_points + _complex_starting_points
+        solutions = []
+        for start in starting_points:
+            try:
+                solution = nsolve(expr, symbol, start, prec=self.dps)
+            except (ValueError, ZeroDivisionError, TypeError):
+                # Didn't converge from there
+                continue
+            real, imaginary = solution.as_real_imag()
+            if abs(imaginary) < tolerance:
+                solution = real
+            elif is_real:
+                continue
+            if not self._is_root(expr, symbol, solution, tolerance):
+                continue
+            if all(abs(solution - other) > tolerance * max(1, abs(other)) for other in solutions):
+                solutions.append(solution)
+        if not solutions:
+            raise ValueError("Could not find any roots of %s" % expr)
+        return solutions
+
+    def _is_root(self, expr, symbol, solution, tolerance):
+        residual = expr.xreplace({symbol: solution}).evalf(self.dps)
+        try:
+            return abs(complex(residual)) < tolerance
+        except TypeError:
+            # e.g. zoo or an unevaluated function
+            return False
+
+
+# Shared by the whole worker session
+solver = Solver()
@@ -0,0 +1,70 @@
+"""
+Substitutes the values of symbols with the cheapest strategy that gives the same result as .subs()
+"""
+
+from collections import Counter
+
+from sympy.core import Symbol, Derivative, Lambda, Subs
+from sympy.concrete.expr_with_limits import ExprWithLimits
+from sympy.series.limits import Limit
+from sympy.series.order import Order
+from sympy.sets.conditionset import ConditionSet
+
+# Expressions which bind symbols, where replacing a symbol isn't the same as substituting it,
+# e.g. Integral(x, (x, 0, 1)) or Derivative(f(x), x)
+_binding_types = (ExprWithLimits, Derivative, Subs, Lambda, Limit, Order, ConditionSet)
+
+
+class Substituter:
+    """
+    Picks a substitution strategy for every map of symbols to values
+    - "none" if there is nothing to substitute
+    - "xreplace" replaces the symbols in one structural pass. That's the same as .subs() as long as
+      no value contains one of the substituted symbols and nothing binds symbols
+    - "subs" for everything else
+
+    evalf(subs=...) isn't one of them, it doesn't give the same results at poles, e.g. 1/x at x = 0 is 0 instead of zoo.
+
+    counts records how often every strategy got used.
+    """
+
+    def __init__(self):
+        self.counts = Counter()
+
+    def substitute(self, expr, values):
+        """
+        Returns expr with the values, which are SymPy expressions, substituted and the strategy that was used
+        """
+        if not values:
+            strategy = "none"
+        elif self._is_structural(expr, values):
+            strategy = "xreplace"
+            expr = expr.xreplace(values)
+        else:
+            strategy = "subs"
+            expr = expr.subs(values)
+        self.counts[strategy] += 1
+        return expr, strategy
+
+    def evalf(self, expr, values, dps=15):
+        """
+        Like expr.subs(values).evalf(dps). Returns the result and the strategy that was used
+        """
+        expr, strategy = self.substitute(expr, values)
+        return expr.evalf(dps), strategy
+
+    def stats(self):
+        return dict(self.counts)
+
+    def _is_structural(self, expr, values):
+        if not all(type(symbol) is Symbol for symbol in values):
+            return False
+        symbols = values.keys()
+        # Otherwise, the order in which .subs() substitutes them would matter
+        if any(not value.free_symbols.isdisjoint(symbols) for value in values.values()):
+            return False
+        return not expr.has(*_binding_types)
+
+
+# Shared by the whole worker session
+substituter = Substituter()
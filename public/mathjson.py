@@ -2,15 +2,28 @@
 A Printer which converts an expression into its MathJson equivalent.
 """
 
-from sympy.core import S, Rational, Pow, Basic, Mul, Number
+import decimal
+import json
+import math
+import sys
+import time
+from collections import Counter, OrderedDict, deque
+
+from sympy.core import S, Rational, Pow, Basic, Mul, Number, Integer, Float, Symbol
 from sympy.core.mul import _keep_coeff
+from sympy.core.function import AppliedUndef, UndefinedFunction, Function
+from sympy.matrices import MatrixBase
+from sympy.polys.polytools import Poly
 from sympy.printing.printer import Printer
 from sympy.printing.precedence import precedence, PRECEDENCE
 
-from mpmath.libmp import prec_to_dps, to_str as mlib_to_str
+from mpmath.libmp import prec_to_dps, from_int, to_str as mlib_to_str, to_float as mlib_to_float
 
 from sympy.utilities import default_sort_key
 
+# Increase whenever the printed MathJson changes, persistent result caches store it with every result
+mathjson_version = 1
+
 # TODO: Update the ones maked with "# TODO: Important Update"
 
 _known_functions_mathjson = {
@@ -61,35 +74,845 @@ _known_functions_mathjson = {
     # '': 'Abs',
 }
 
+class PrintCache:
+    """
+    A least recently used cache for printed subtrees. Since SymPy expressions are immutable,
+    a printed subtree can be reused across printers and across calls.
+
+    The size of an entry is the length of a printed string, or the shallow size of a printed tree,
+    since the children of a cached tree are shared with their own cache entries.
+    """
+
+    def __init__(self, max_entries=10000, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._bytes = 0
+
+    def get(self, key, default=None):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    def put(self, key, value):
+        size = len(value) if isinstance(value, str) else sys.getsizeof(value)
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        old_entry = self._entries.pop(key, None)
+        if old_entry is not None:
+            self._bytes -= old_entry[1]
+        self._entries[key] = (value, size)
+        self._bytes += size
+        while len(self._entries) > self.max_entries or (self.max_bytes is not None and self._bytes > self.max_bytes):
+            _, (_, evicted_size) = self._entries.popitem(last=False)
+            self._bytes -= evicted_size
+
+    def clear(self):
+        self._entries.clear()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+        }
+
+    def __len__(self):
+        return len(self._entries)
+
+
+# Shared by all printers of a worker session which opt into caching
+print_cache = PrintCache()
+# The ordered terms and factors of Adds and Muls, for printers which opt into caching them
+order_cache = PrintCache()
+
+class NameTable:
+    """
+    Encodes and decodes symbol names like encodeName and decodeName in pyodide-cas.ts. Names which
+    only have ASCII letters get a _ in front, everything else becomes __ followed by two letters
+    from A to P for every byte of its UTF-8 encoding.
+
+    Both directions are memoized and the names are interned, since the same few names show up in every command.
+    """
+
+    def __init__(self):
+        self._encoded = dict()
+        self._decoded = dict()
+
+    def encode(self, name):
+        encoded = self._encoded.get(name)
+        if encoded is None:
+            if name.isascii() and name.isalpha():
+                encoded = '_' + name
+            else:
+                encoded = '__' + ''.join(chr(65 + (byte >> 4)) + chr(65 + (byte & 15)) for byte in name.encode('utf-8'))
+            encoded = self._encoded[name] = sys.intern(encoded)
+            self._decoded[encoded] = sys.intern(name)
+        return encoded
+
+    def decode(self, name):
+        decoded = self._decoded.get(name)
+        if decoded is None:
+            decoded = name
+            if name.startswith('__'):
+                letters = name[2:]
+                if len(letters) % 2 == 0 and all('A' <= letter <= 'P' for letter in letters):
+                    data = bytes(
+                        (ord(letters[i]) - 65) << 4 | (ord(letters[i + 1]) - 65) for i in range(0, len(letters), 2)
+                    )
+                    try:
+                        decoded = data.decode('utf-8')
+                    except UnicodeDecodeError:
+                        pass
+            elif name.startswith('_'):
+                decoded = name[1:]
+            decoded = self._decoded[name] = sys.intern(decoded)
+        return decoded
+
+    def __len__(self):
+        return len(self._decoded)
+
+
+# Shared by the builder and the printers of a worker session
+name_table = NameTable()
+
+class SymbolRegistry:
+    """
+    Interns symbols for the lifetime of a session, so that every command gets the very same Symbol
+    objects and SymPy's caches keep working across commands.
+
+    A name can have default assumptions, e.g. assume("x", positive=True), which every later
+    symbol("x") gets. Explicit assumptions get their own symbol.
+    """
+
+    def __init__(self):
+        # (name, sorted assumptions) -> Symbol
+        self._symbols = dict()
+        self._assumptions = dict()
+
+    def symbol(self, name, **assumptions):
+        key = (name, tuple(sorted(assumptions.items())) if assumptions else self._assumptions.get(name, ()))
+        symbol = self._symbols.get(key)
+        if symbol is None:
+            symbol = self._symbols[key] = Symbol(name, **dict(key[1]))
+        return symbol
+
+    def assume(self, name, **assumptions):
+        """
+        Changes the default assumptions of a name. Expressions which have already been built keep their old symbols.
+        """
+        self._assumptions[name] = tuple(sorted(assumptions.items()))
+
+    def __len__(self):
+        return len(self._symbols)
+
+
+# Shared by every builder and every evaluated expression of a worker session
+symbol_registry = SymbolRegistry()
+
+class PrinterDiagnostics:
+    """
+    Counts how often printing methods without proper MathJson support get called, per method and per type,
+    and how often an expression got printed differently than configured, per reason and per type.
+    Printing a warning for every single node would be far too slow, so at most one summary
+    gets printed per doprint and at most one every `min_interval` seconds.
+    """
+
+    def __init__(self, min_interval=1.0):
+        self.min_interval = min_interval
+        self.counts = Counter()
+        self.fallbacks = Counter()
+        self._unreported = Counter()
+        self._unreported_fallbacks = Counter()
+        self._last_report_time = None
+
+    def record(self, method, expr):
+        key = (method, type(expr).__name__)
+        self.counts[key] += 1
+        self._unreported[key] += 1
+
+    def record_fallback(self, reason, expr):
+        key = (reason, type(expr).__name__)
+        self.fallbacks[key] += 1
+        self._unreported_fallbacks[key] += 1
+
+    def report(self):
+        if not self._unreported and not self._unreported_fallbacks:
+            return
+        now = time.monotonic()
+        if self._last_report_time is not None and now - self._last_report_time < self.min_interval:
+            # Gets included in the next summary
+            return
+        self._last_report_time = now
+        if self._unreported:
+            print("Warning: Unsupported printing methods were called: " + ", ".join(
+                "%s(%s) %d times" % (method, type_name, count) for (method, type_name), count in self._unreported.most_common()
+            ))
+        if self._unreported_fallbacks:
+            print("Warning: Printed differently than configured: " + ", ".join(
+                "%s(%s) %d times" % (reason, type_name, count) for (reason, type_name), count in self._unreported_fallbacks.most_common()
+            ))
+        self._unreported.clear()
+        self._unreported_fallbacks.clear()
+
+    def summary(self):
+        return [
+            {"method": method, "type": type_name, "count": count}
+            for (method, type_name), count in self.counts.most_common()
+        ] + [
+            {"fallback": reason, "type": type_name, "count": count}
+            for (reason, type_name), count in self.fallbacks.most_common()
+        ]
+
+    def clear(self):
+        self.counts.clear()
+        self.fallbacks.clear()
+        self._unreported.clear()
+        self._unreported_fallbacks.clear()
+        self._last_report_time = None
+
+
+# Can be queried from the worker, e.g. diagnostics.summary()
+diagnostics = PrinterDiagnostics()
+
+_missing = object()
+
+# Settings of printers -> their number, see MathJsonPrinter._cache_key
+_settings_keys = dict()
+
+def _subtree_children(node):
+    if isinstance(node, MatrixBase):
+        # Row-major, like the printed matrix. Immutable matrices have their shape in their args as well
+        return _matrix_elements(node)
+    elif isinstance(node, Poly):
+        # Printed from its terms, not from the expression in its args
+        return ()
+    elif isinstance(node, Basic):
+        return node.args
+    elif isinstance(node, (list, tuple)):
+        return node
+    else:
+        return ()
+
+def _matrix_elements(matrix):
+    elements = getattr(matrix, '_mat', None)
+    if elements is None:
+        # Sparse matrices
+        elements = list(matrix)
+    return elements
+
+def _shared_subtrees(expr, min_size):
+    """
+    Finds the subtrees which appear more than once in expr and have at least min_size nodes.
+    Equal subtrees only get visited once, so this is linear in the number of distinct subtrees.
+    Returns a dictionary from the subtrees to None.
+    """
+    counts = dict()
+    sizes = dict()
+    stack = [(expr, False)]
+    while stack:
+        node, children_counted = stack.pop()
+        is_basic = isinstance(node, Basic)
+        children = _subtree_children(node)
+        if not children_counted:
+            if is_basic:
+                count = counts.get(node, 0)
+                counts[node] = count + 1
+                if count:
+                    continue
+            stack.append((node, True))
+            for child in children:
+                stack.append((child, False))
+        elif is_basic:
+            sizes[node] = 1 + sum(sizes.get(child, 1) for child in children)
+    return {node: None for node, count in counts.items() if count > 1 and sizes[node] >= min_size}
+
+def _shared_size(expr, min_size):
+    """
+    The number of nodes in the output of the "shared_subtrees" setting, counted like MathJsonStreamWriter counts them.
+    That's the body and every definition, where every reference is one node.
+    """
+    if _is_deeper(expr, _max_recursive_depth()):
+        # Printed without shared subtrees, see MathJsonPrinter._begin_deep
+        shared = dict()
+    else:
+        shared = _shared_subtrees(expr, min_size)
+    sizes = dict()
+    stack = [(expr, False)]
+    while stack:
+        node, children_counted = stack.pop()
+        if id(node) in sizes:
+            continue
+        children = _subtree_children(node)
+        if not children_counted:
+            stack.append((node, True))
+            for child in children:
+                if id(child) not in sizes:
+                    stack.append((child, False))
+        else:
+            sizes[id(node)] = 1 + sum(
+                1 if isinstance(child, Basic) and child in shared else sizes[id(child)] for child in children
+            )
+    definitions = dict()
+    for node in shared:
+        # Equal subtrees only get defined once
+        definitions.setdefault(node, sizes.get(id(node), 0))
+    return sizes[id(expr)] + sum(definitions.values())
+
+def _is_deeper(expr, limit):
+    """
+    Whether expr has more than limit levels, computed bottom up and without recursion
+    """
+    heights = dict()
+    stack = [(expr, False)]
+    while stack:
+        node, children_measured = stack.pop()
+        if id(node) in heights:
+            continue
+        children = _subtree_children(node)
+        if not children_measured:
+            stack.append((node, True))
+            for child in children:
+                if id(child) not in heights:
+                    stack.append((child, False))
+        else:
+            height = heights[id(node)] = 1 + max((heights[id(child)] for child in children), default=0)
+            if height > limit:
+                return True
+    return False
+
+def _max_recursive_depth():
+    # SymPy needs a few stack frames per level when it sorts, hashes or compares trees recursively
+    return sys.getrecursionlimit() // 10
+
+def _exponent_key(exponent):
+    return -float(exponent) if exponent.is_Number else -1.0
+
+def _fast_factor_key(factor):
+    """
+    Numbers first, then powers of symbols by name and then everything else by type
+    """
+    if factor.is_Number:
+        return (0, '', 0.0)
+    base, exponent = factor.as_base_exp()
+    if base.is_Symbol:
+        return (1, base.name, _exponent_key(exponent))
+    return (2, type(base).__name__, _exponent_key(exponent))
+
+def _fast_term_key(term):
+    """
+    Highest total degree first and constants last, like a graded ordering of the monomials.
+    Ties keep the order of the arguments.
+    """
+    _, rest = term.as_coeff_Mul()
+    if rest is S.One:
+        return (1, 0.0, ())
+    keys = sorted(map(_fast_factor_key, Mul.make_args(rest)))
+    return (0, sum(key[2] for key in keys), keys)
+
+_max_exact_float = 2 ** 53
+
+def _machine_numbers(elements):
+    """
+    Returns the elements as Python ints or floats without losing anything, or None if that isn't possible
+    """
+    if all(isinstance(element, Integer) and -_max_exact_float <= element.p <= _max_exact_float for element in elements):
+        return [element.p for element in elements]
+
+    values = []
+    for element in elements:
+        if isinstance(element, Integer) and -_max_exact_float <= element.p <= _max_exact_float:
+            values.append(float(element.p))
+        elif isinstance(element, Float) and element._prec <= 53:
+            value = mlib_to_float(element._mpf_)
+            if not math.isfinite(value):
+                return None
+            values.append(value)
+        else:
+            return None
+    return values
+
+# Integers with fewer bits than this have fewer than 4300 digits, the limit of str() on newer Pythons
+_max_str_bits = 8192
+
+def _integer_text(value, max_digits):
+    """
+    Returns the decimal digits of a big integer. str() takes quadratic time, so larger integers
+    get converted with the decimal module instead. Integers with more than max_digits digits
+    get rounded to their leading digits, e.g. 1.23e+100000
+    """
+    bits = value.bit_length()
+    if max_digits is not None and (bits - 1) * _log10_2 >= max_digits:
+        return mlib_to_str(from_int(value, 128), 30)
+    if bits <= _max_str_bits:
+        return str(value)
+    return str(_int_to_decimal(value))
+
+_log10_2 = math.log10(2)
+
+def _int_to_decimal(value):
+    """
+    Converts an integer to a Decimal by splitting it in half recursively. The multiplications
+    of the decimal module are subquadratic, unlike int to str conversions.
+    """
+    powers = dict()
+
+    def power_of_two(bits):
+        result = powers.get(bits)
+        if result is None:
+            if bits <= 128:
+                result = decimal.Decimal(2) ** bits
+            else:
+                half = bits >> 1
+                result = power_of_two(half) * power_of_two(bits - half)
+            powers[bits] = result
+        return result
+
+    def convert(value, bits):
+        if bits <= 128:
+            return decimal.Decimal(value)
+        half = bits >> 1
+        high = value >> half
+        low = value - (high << half)
+        return convert(low, half) + convert(high, bits - half) * power_of_two(half)
+
+    with decimal.localcontext() as context:
+        context.prec = decimal.MAX_PREC
+        context.Emax = decimal.MAX_EMAX
+        context.Emin = decimal.MIN_EMIN
+        context.traps[decimal.Inexact] = 1
+        if value < 0:
+            return -convert(-value, (-value).bit_length())
+        return convert(value, value.bit_length())
+
+def _format_double(value, strip_zeros, min_fixed, max_fixed):
+    """
+    Formats a double with 15 digits, exactly like mlib_to_str. Returns None if it can't, e.g.
+    for subnormal numbers or when the rounding is ambiguous.
+    """
+    if not sys.float_info.min <= abs(value) <= sys.float_info.max:
+        return None
+    mantissa, exponent = ('%.17e' % value).split('e')
+    sign = ''
+    if mantissa[0] == '-':
+        sign = '-'
+        mantissa = mantissa[1:]
+    digits = mantissa[0] + mantissa[2:]
+    if digits[16:] == '00':
+        # mlib_to_str rounds the truncated digits, which differs if rounding to 18 digits carried over.
+        # Unless 15 digits are enough to get the same double, like for 1.5
+        short = '%.14e' % abs(value)
+        if float(short) != abs(value):
+            return None
+        mantissa, exponent = short.split('e')
+        digits = mantissa[0] + mantissa[2:]
+        exponent = int(exponent)
+    else:
+        exponent = int(exponent)
+        if digits[15] in '56789':
+            digits = str(int(digits[:15]) + 1)
+            if len(digits) > 15:
+                digits = digits[:15]
+                exponent += 1
+        else:
+            digits = digits[:15]
+
+    if min_fixed is None:
+        min_fixed = -5
+    if max_fixed is None:
+        max_fixed = 15
+    if min_fixed < exponent < max_fixed:
+        if exponent < 0:
+            digits = "0" * -exponent + digits
+            split = 1
+        else:
+            split = exponent + 1
+            if split > 15:
+                digits += "0" * (split - 15)
+        exponent = 0
+    else:
+        split = 1
+    digits = digits[:split] + "." + digits[split:]
+    if strip_zeros:
+        digits = digits.rstrip('0')
+        if digits[-1] == ".":
+            digits += "0"
+
+    if exponent == 0:
+        return sign + digits
+    if exponent > 0:
+        return sign + digits + "e+" + str(exponent)
+    return sign + digits + "e" + str(exponent)
+
+class _Unreferenced:
+    """
+    A shared subtree which has been printed, but not referenced yet
+    """
+    __slots__ = ("definition",)
+
+    def __init__(self, definition):
+        self.definition = definition
+
 class MathJsonPrinter(Printer):
     printmethod = "_mathjson"
     _default_settings = {
         "order": None,
+        # How the terms of an Add and the factors of a Mul get ordered
+        # - "canonical" sorts them like the other SymPy printers, which is slow for large Adds
+        # - "fast" sorts them with a cheap key, which only looks at the factors of every term
+        # - "none" keeps the order of their args
+        "ordering": "canonical",
+        # A PrintCache for the ordered terms and factors, e.g. order_cache
+        "order_cache": None,
         "full_prec": "auto",
         "perm_cyclic": True,
         "min": None,
         "max": None,
+        "print_cache": None,
+        # Prints trees which are too deep to be printed recursively bottom up, with an explicit stack
+        "iterative": False,
+        "max_integer_digits": 100000,
+        # A cas_cancellation.Cancellation, which gets checked while printing
+        "cancellation": None,
+        # Prints subtrees which appear more than once as ["Shared", ["List", ...definitions], body],
+        # where ["Ref", i] stands for the i-th definition. See expand_shared
+        "shared_subtrees": False,
+        "min_shared_size": 4,
+        # "sparse" prints polynomials as ["Polynomial", ["List", ...generators], ["List", ...exponents], ["List", ...coefficients]]
+        # "expanded" prints them as their expression, e.g. an Add
+        "polynomials": "sparse",
+        # A NameTable, which decodes the names of symbols. Otherwise, they get printed as they are
+        "name_table": None,
     }
 
     _relationals = dict()
 
+    # Maps the type of an expression to the function which prints it, filled in on first sight of a type
+    _dispatch_table = dict()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._dispatch_table = dict()
+
+    def __init__(self, settings=None):
+        super().__init__(settings)
+        # Cached subtrees could contain references to the definitions of another output
+        self._print_cache = self._settings["print_cache"] if not self._settings["shared_subtrees"] else None
+        self._cancellation = self._settings["cancellation"]
+        self._order_cache = self._settings["order_cache"]
+        self._name_table = self._settings["name_table"]
+        # Subtrees which have already been printed by the iterative traversal, keyed by id
+        self._printed_subtrees = None
+        # Whether the current expression is too deep to be printed recursively, see _begin_deep
+        self._deep = False
+        # (id of an Add or Mul, order) -> its ordered args, computed bottom up for deep expressions
+        self._deep_orders = None
+        # Shared subtree -> its reference, or None if it hasn't been printed yet
+        self._shared = None
+        self._definitions = None
+        # The shared subtree which is currently being printed in advance, see _print_subtrees
+        self._defining = None
+        # Printers with different settings must not share cache entries. Numbered, since hashing all the settings
+        # for every lookup would take longer than printing most subtrees
+        settings_key = (type(self),) + tuple(sorted(
+            (key, value) for key, value in self._settings.items() if key not in ("print_cache", "order_cache", "cancellation")
+        ))
+        self._cache_key = _settings_keys.setdefault(settings_key, len(_settings_keys))
+        self._resolve_settings()
+
+    def _resolve_settings(self):
+        # Read by _print_Float, which gets called far too often to look them up every time
+        self._float_settings = (self._settings["full_prec"], self._settings["min"], self._settings["max"])
+
+    def _print(self, expr, **kwargs):
+        """
+        Dispatches on the concrete type of the expression. Unlike Printer._print,
+        the MRO only gets walked the first time a type shows up.
+        """
+        if self._cancellation is not None:
+            self._cancellation.tick()
+        self._print_level += 1
+        try:
+            if self._printed_subtrees is not None:
+                result = self._printed_subtrees.get(id(expr), _missing)
+                if result is not _missing:
+                    return result
+
+            expr_type = type(expr)
+            handler = self._dispatch_table.get(expr_type)
+            if handler is None:
+                handler = self._dispatch_table[expr_type] = self._resolve_handler(expr_type)
+
+            if self._shared is not None and not kwargs and isinstance(expr, Basic) and expr is not self._defining and expr in self._shared:
+                return self._print_shared(expr, handler)
+
+            # Leaves are cheaper to print than to look up
+            if self._print_cache is None or kwargs or not isinstance(expr, Basic) or not expr.args:
+                return handler(self, expr, **kwargs)
+
+            # The nesting level is part of the key, since it changes how floats get printed
+            key = (self._cache_key, self._print_level > 1, expr_type, expr)
+            result = self._print_cache.get(key, _missing)
+            if result is _missing:
+                result = handler(self, expr)
+                self._print_cache.put(key, result)
+            return result
+        finally:
+            self._print_level -= 1
+
+    def doprint(self, expr):
+        return self._str(self._print_root(expr))
+
+    def _begin_deep(self, expr, like=None):
+        """
+        Trees which are too deep to be printed recursively get printed bottom up, see _print_subtrees.
+        Comparing equal trees in the caches is recursive as well, so they don't use any caches or shared subtrees.
+        The ordered terms get computed in advance, see _prepare_deep. A printer which has to agree with another
+        one takes the ordered terms of like. Returns the settings for _end_deep, or None if expr isn't that deep.
+        """
+        if self._deep or not self._settings["iterative"]:
+            return None
+        if not (like._deep if like is not None else _is_deeper(expr, _max_recursive_depth())):
+            return None
+        saved = (self._settings["ordering"], self._settings["shared_subtrees"], self._print_cache, self._order_cache)
+        self._deep = True
+        self._print_cache = None
+        self._order_cache = None
+        if self._settings["shared_subtrees"]:
+            self._settings["shared_subtrees"] = False
+            diagnostics.record_fallback("no shared subtrees in deep trees", expr)
+        if like is not None:
+            self._settings["ordering"] = like._settings["ordering"]
+            self._deep_orders = like._deep_orders
+        else:
+            self._prepare_deep(expr)
+        return saved
+
+    def _end_deep(self, saved):
+        if saved is not None:
+            self._settings["ordering"], self._settings["shared_subtrees"], self._print_cache, self._order_cache = saved
+            self._deep = False
+            self._deep_orders = None
+
+    def _prepare_deep(self, expr):
+        """
+        SymPy computes hashes and sort keys recursively, so they get computed bottom up, together with the ordered
+        args of every Add and Mul. If sorting still recurses too deeply, e.g. when it compares two equal, but distinct
+        deep subtrees, the "fast" ordering gets used instead and diagnostics records that.
+        """
+        try:
+            self._deep_orders = self._ordered_subtrees(expr)
+        except RecursionError:
+            if self._settings["ordering"] != "canonical":
+                raise
+            self._settings["ordering"] = "fast"
+            diagnostics.record_fallback("fast ordering in deep trees", expr)
+            self._deep_orders = self._ordered_subtrees(expr)
+
+    def _ordered_subtrees(self, expr):
+        orders = dict()
+        sort_keys = self._settings["ordering"] == "canonical" and self.order not in ('old', 'none')
+        cancellation = self._cancellation
+        visited = set()
+        stack = [(expr, False)]
+        while stack:
+            if cancellation is not None:
+                cancellation.tick()
+            node, children_visited = stack.pop()
+            if id(node) in visited:
+                continue
+            children = _subtree_children(node)
+            if not children_visited:
+                stack.append((node, True))
+                for child in children:
+                    if id(child) not in visited:
+                        stack.append((child, False))
+                continue
+            visited.add(id(node))
+            if not isinstance(node, Basic):
+                continue
+            hash(node)
+            if sort_keys:
+                node.sort_key()
+            if node.is_Add or node.is_Mul:
+                orders[(id(node), None)] = self._ordered_args(node)
+        return orders
+
+    def _print_root(self, expr):
+        self._resolve_settings()
+        result = self._cached_root(expr)
+        if result is not _missing:
+            return result
+        saved = self._begin_deep(expr)
+        try:
+            return self._print_root_body(expr)
+        finally:
+            self._end_deep(saved)
+
+    def _cached_root(self, expr):
+        """
+        The printed expr if it's in the print cache, which is cheaper than looking at its depth
+        """
+        if self._print_cache is None or not isinstance(expr, Basic) or not expr.args:
+            return _missing
+        try:
+            # Same key as in _print
+            return self._print_cache.get((self._cache_key, False, type(expr), expr), _missing)
+        except RecursionError:
+            # Too deep to be hashed recursively, see _begin_deep
+            return _missing
+
+    def _print_root_body(self, expr):
+        if not self._settings["shared_subtrees"]:
+            return self._print_body(expr)
+
+        self._shared = _shared_subtrees(expr, self._settings["min_shared_size"])
+        self._definitions = []
+        try:
+            body = self._print_body(expr)
+            if not self._definitions:
+                return body
+            return self._function("Shared", [self._function("List", self._definitions), body])
+        finally:
+            self._shared = None
+            self._definitions = None
+
+    def _print_body(self, expr):
+        try:
+            if not self._deep:
+                return self._print(expr)
+
+            self._print_subtrees(expr)
+            try:
+                return self._print(expr)
+            finally:
+                self._printed_subtrees = None
+        finally:
+            diagnostics.report()
+
+    def _print_shared(self, expr, handler):
+        """
+        The first time a shared subtree shows up, it gets printed as the next definition. Afterwards, it's only referenced
+        """
+        reference = self._shared[expr]
+        if reference is None or type(reference) is _Unreferenced:
+            # The shared subtrees inside of it get their definitions first
+            self._definitions.append(handler(self, expr) if reference is None else reference.definition)
+            reference = self._shared[expr] = self._function("Ref", [self._integer(len(self._definitions) - 1)])
+        return reference
+
+    def _warn(self, method, expr):
+        diagnostics.record(method, expr)
+
+    def _print_subtrees(self, expr):
+        """
+        Prints every subtree of expr bottom up, using an explicit stack instead of recursion.
+        Afterwards, printing expr only needs to look up the already printed children.
+        """
+        printed = self._printed_subtrees = dict()
+        cancellation = self._cancellation
+        stack = [(expr, False)]
+        while stack:
+            if cancellation is not None:
+                cancellation.tick()
+            node, children_printed = stack.pop()
+            if id(node) in printed:
+                continue
+            if self._shared is not None and isinstance(node, Basic) and self._shared.get(node) is not None:
+                # An equal subtree has already been printed, so there's no need to look at its children
+                continue
+            children = _subtree_children(node)
+            if not children:
+                # Leaves don't recurse, so they can be printed when they're needed
+                continue
+            if not children_printed:
+                stack.append((node, True))
+                for child in children:
+                    if id(child) not in printed:
+                        stack.append((child, False))
+            elif node is not expr:
+                # Subtrees are never at the top level
+                self._print_level = 1
+                try:
+                    if self._shared is not None and isinstance(node, Basic) and node in self._shared:
+                        # Only becomes a definition once its parent gets printed, some parents skip a level
+                        self._defining = node
+                        self._shared[node] = _Unreferenced(self._print(node))
+                    else:
+                        printed[id(node)] = self._print(node)
+                finally:
+                    self._print_level = 0
+                    self._defining = None
+
+    @classmethod
+    def _resolve_handler(cls, expr_type):
+        # Same lookup rules as Printer._print
+        if cls.printmethod and hasattr(expr_type, cls.printmethod) and not issubclass(expr_type, type):
+            return lambda printer, expr, **kwargs: getattr(expr, printer.printmethod)(printer, **kwargs)
+
+        classes = expr_type.__mro__
+        if AppliedUndef in classes:
+            classes = classes[classes.index(AppliedUndef):]
+        if UndefinedFunction in classes:
+            classes = classes[classes.index(UndefinedFunction):]
+        if Function in classes:
+            i = classes.index(Function)
+            classes = tuple(c for c in classes[:i] if \
+                c.__name__ == classes[0].__name__ or \
+                c.__name__.endswith("Base")) + classes[i:]
+
+        for c in classes:
+            printmethodname = '_print_' + c.__name__
+            printmethod = getattr(cls, printmethodname, None)
+            if printmethod is None:
+                continue
+            if printmethodname == '_print_Function' and expr_type.__name__ in _known_functions_mathjson:
+                # Known functions directly map to their MathJson name
+                name = _known_functions_mathjson[expr_type.__name__]
+                return lambda printer, expr, **kwargs: printer._function(name, [printer._print(o) for o in expr.args])
+            return printmethod
+
+        return cls.emptyPrinter
+
     def _quotes(self, text):
         return '"%s"' % text
 
+    def _integer(self, value):
+        if -_max_exact_float <= value <= _max_exact_float:
+            return str(value)
+        return '{"num":"%s"}' % _integer_text(value, self._settings["max_integer_digits"])
+
+    def _float(self, text):
+        return text
+
     def _function(self, name, args, requires_multiple_args=False):
         if requires_multiple_args and len(args) == 1:
             return str(args[0])
         else:
-            return "[\"%s\",%s]" % (name, ','.join(args))
+            return "[%s]" % ','.join(['"%s"' % name, *args])
+
+    def _numbers(self, values):
+        # A list of Python ints or finite floats, which don't need to be printed one by one
+        return '[%s]' % ','.join(['"List"', *map(repr, values)])
 
     # TODO: Update
     def parenthesize(self, item, level, strict=False):
-        print("Warning: parenthesize was called")
+        self._warn("parenthesize", item)
         return "(%s)" % self._print(item)
 
     # TODO: Update
     def stringify(self, args, sep, level=0):
-        print("Warning: stringify was called")
+        self._warn("stringify", args)
         return sep.join([self.parenthesize(item, level) for item in args])
 
     def emptyPrinter(self, expr):
@@ -100,8 +923,45 @@ class MathJsonPrinter(Printer):
         else:
             return str(expr)
 
+    def _ordered_args(self, expr, order=None):
+        """
+        The terms of an Add or the factors of a Mul, ordered according to the "ordering" setting
+        """
+        ordering = self._settings["ordering"]
+        if ordering == "none":
+            return expr.args
+        if self._deep_orders is not None:
+            ordered = self._deep_orders.get((id(expr), order))
+            if ordered is not None:
+                return ordered
+        if self._order_cache is not None:
+            key = (ordering, order or self.order, expr)
+            ordered = self._order_cache.get(key)
+            if ordered is not None:
+                return ordered
+
+        if ordering == "fast":
+            if expr.is_Add:
+                ordered = sorted(expr.args, key=_fast_term_key)
+            else:
+                # Non-commutative factors stay where they are
+                ordered = sorted([arg for arg in expr.args if arg.is_commutative], key=_fast_factor_key)
+                ordered += [arg for arg in expr.args if not arg.is_commutative]
+        elif expr.is_Add:
+            ordered = self._as_ordered_terms(expr, order=order)
+        elif self.order not in ('old', 'none'):
+            ordered = expr.as_ordered_factors()
+        else:
+            # use make_args in case expr was something like -x -> x
+            ordered = Mul.make_args(expr)
+
+        ordered = tuple(ordered)
+        if self._order_cache is not None:
+            self._order_cache.put(key, ordered)
+        return ordered
+
     def _print_Add(self, expr, order=None):
-        terms = self._as_ordered_terms(expr, order=order)
+        terms = self._ordered_args(expr, order=order)
         l = []
         for term in terms:
             l.append(self._print(term))
@@ -109,65 +969,65 @@ class MathJsonPrinter(Printer):
 
     # TODO: Update
     def _print_BooleanTrue(self, expr):
-        print("Warning: _print_BooleanTrue was called")
+        self._warn("_print_BooleanTrue", expr)
         return "True"
 
     # TODO: Update
     def _print_BooleanFalse(self, expr):
-        print("Warning: _print_BooleanFalse was called")
+        self._warn("_print_BooleanFalse", expr)
         return "False"
 
     # TODO: Update
     def _print_Not(self, expr):
-        print("Warning: _print_Not was called")
+        self._warn("_print_Not", expr)
         return '~%s' %(self.parenthesize(expr.args[0],PRECEDENCE["Not"]))
 
     # TODO: Update
     def _print_And(self, expr):
-        print("Warning: _print_And was called")
+        self._warn("_print_And", expr)
         return self.stringify(expr.args, " & ", PRECEDENCE["BitwiseAnd"])
 
     # TODO: Update
     def _print_Or(self, expr):
-        print("Warning: _print_Or was called")
+        self._warn("_print_Or", expr)
         return self.stringify(expr.args, " | ", PRECEDENCE["BitwiseOr"])
 
     # TODO: Update
     def _print_Xor(self, expr):
-        print("Warning: _print_Xor was called")
+        self._warn("_print_Xor", expr)
         return self.stringify(expr.args, " ^ ", PRECEDENCE["BitwiseXor"])
 
     # TODO: Update
     def _print_AppliedPredicate(self, expr):
-        print("Warning: _print_AppliedPredicate was called")
+        self._warn("_print_AppliedPredicate", expr)
         return '%s(%s)' % (self._print(expr.func), self._print(expr.arg))
 
     # TODO: Update
     def _print_Basic(self, expr):
-        print("Warning: _print_Basic was called")
+        self._warn("_print_Basic", expr)
         l = [self._print(o) for o in expr.args]
         return expr.__class__.__name__ + "(%s)" % ", ".join(l)
 
     # TODO: Update
     def _print_BlockMatrix(self, B):
-        print("Warning: _print_BlockMatrix was called")
+        self._warn("_print_BlockMatrix", B)
         if B.blocks.shape == (1, 1):
             self._print(B.blocks[0, 0])
         return self._print(B.blocks)
 
     # TODO: Update
     def _print_Catalan(self, expr):
-        print("Warning: _print_Catalan was called")
-        return self._print('"CatalanConstant"')
+        self._warn("_print_Catalan", expr)
+        return self._quotes('CatalanConstant')
 
     # TODO: Update
     def _print_ComplexInfinity(self, expr):
-        print("Warning: _print_ComplexInfinity was called")
+        self._warn("_print_ComplexInfinity", expr)
         return 'zoo'
 
     # TODO: Update
     def _print_ConditionSet(self, s):
-        print("Warning: _print_ConditionSet was called")
+        self._warn("_print_ConditionSet", s)
         args = tuple([self._print(i) for i in (s.sym, s.condition)])
         if s.base_set is S.UniversalSet:
             return 'ConditionSet(%s, %s)' % args
@@ -176,14 +1036,14 @@ class MathJsonPrinter(Printer):
 
     # TODO: Update
     def _print_Derivative(self, expr):
-        print("Warning: _print_Derivative was called")
+        self._warn("_print_Derivative", expr)
         dexpr = expr.expr
         dvars = [i[0] if i[1] == 1 else i for i in expr.variable_count]
         return 'Derivative(%s)' % ", ".join(map(lambda arg: self._print(arg), [dexpr] + dvars))
 
     # TODO: Update
     def _print_dict(self, d):
-        print("Warning: _print_dict was called")
+        self._warn("_print_dict", d)
         keys = sorted(d.keys(), key=default_sort_key)
         items = []
 
@@ -195,42 +1055,44 @@ class MathJsonPrinter(Printer):
 
     # TODO: Update
     def _print_Dict(self, expr):
-        print("Warning: _print_Dict was called")
+        self._warn("_print_Dict", expr)
         return self._print_dict(expr)
 
     # TODO: Update
     def _print_RandomDomain(self, d):
-        print("Warning: _print_RandomDomain was called")
+        self._warn("_print_RandomDomain", d)
         if hasattr(d, 'as_boolean'):
-            return 'Domain: ' + self._print(d.as_boolean())
+            return 'Domain: ' + self._str(self._print(d.as_boolean()))
         elif hasattr(d, 'set'):
-            return ('Domain: ' + self._print(d.symbols) + ' in ' +
-                    self._print(d.set))
+            return ('Domain: ' + self._str(self._print(d.symbols)) + ' in ' +
+                    self._str(self._print(d.set)))
         else:
-            return 'Domain on ' + self._print(d.symbols)
+            return 'Domain on ' + self._str(self._print(d.symbols))
 
     def _print_Dummy(self, expr):
+        if self._name_table is not None:
+            return self._quotes(self._name_table.decode(expr.name))
         return self._quotes('_' + expr.name)
 
     # TODO: Important Update
     def _print_EulerGamma(self, expr):
-        print("Warning: _print_EulerGamma was called")
+        self._warn("_print_EulerGamma", expr)
         # return 'EulerGamma'
-        return self._print('"EulerGamma"')
+        return self._quotes('EulerGamma')
 
     # TODO: Important Update
     def _print_Exp1(self, expr):
-        print("Warning: _print_Exp1 was called")
-        return self._print('"ExponentialE"')
+        self._warn("_print_Exp1", expr)
+        return self._quotes('ExponentialE')
 
     # TODO: Update
     def _print_ExprCondPair(self, expr):
-        print("Warning: _print_ExprCondPair was called")
+        self._warn("_print_ExprCondPair", expr)
         return '(%s, %s)' % (self._print(expr.expr), self._print(expr.cond))
 
     # TODO: Update
     def _print_Function(self, expr):
-        print("Warning: _print_Function was called", expr.args)
+        self._warn("_print_Function", expr)
         if expr.func.__name__ in _known_functions_mathjson:
             name = r"%s" % _known_functions_mathjson[expr.func.__name__]
             args = [self._print(o) for o in expr.args]
@@ -240,27 +1102,27 @@ class MathJsonPrinter(Printer):
         return name + "(%s)" % self.stringify(expr.args, ", ")
 
     def _print_GoldenRatio(self, expr):
-        print("Warning: _print_GoldenRatio was called")
-        return self._print('"GoldenRatio"')
+        self._warn("_print_GoldenRatio", expr)
+        return self._quotes('GoldenRatio')
 
     # TODO: Update
     def _print_TribonacciConstant(self, expr):
-        print("Warning: _print_TribonacciConstant was called")
+        self._warn("_print_TribonacciConstant", expr)
         return 'TribonacciConstant'
 
     # TODO: Important Update
     def _print_ImaginaryUnit(self, expr):
-        print("Warning: _print_ImaginaryUnit was called")
-        return self._print('"ImaginaryUnit"')
+        self._warn("_print_ImaginaryUnit", expr)
+        return self._quotes('ImaginaryUnit')
 
     # TODO: Important Update
     def _print_Infinity(self, expr):
-        print("Warning: _print_Infinity was called")
+        self._warn("_print_Infinity", expr)
         return 'oo'
 
     # TODO: Update
     def _print_Integral(self, expr):
-        print("Warning: _print_Integral was called")
+        self._warn("_print_Integral", expr)
         # TODO: Update
         def _xab_tostr(xab):
             if len(xab) == 1:
@@ -272,7 +1134,7 @@ class MathJsonPrinter(Printer):
 
     # TODO: Update
     def _print_Interval(self, i):
-        print("Warning: _print_Interval was called")
+        self._warn("_print_Interval", i)
         fin =  'Interval{m}({a}, {b})'
         a, b, l, r = i.args
         if a.is_infinite and b.is_infinite:
@@ -293,18 +1155,18 @@ class MathJsonPrinter(Printer):
 
     # TODO: Update
     def _print_AccumulationBounds(self, i):
-        print("Warning: _print_AccumulationBounds was called")
+        self._warn("_print_AccumulationBounds", i)
         return "AccumBounds(%s, %s)" % (self._print(i.min),
                                         self._print(i.max))
 
     # TODO: Update
     def _print_Inverse(self, I):
-        print("Warning: _print_Inverse was called")
+        self._warn("_print_Inverse", I)
         return "%s**(-1)" % self.parenthesize(I.arg, PRECEDENCE["Pow"])
 
     # TODO: Update
     def _print_Lambda(self, obj):
-        print("Warning: _print_Lambda was called")
+        self._warn("_print_Lambda", obj)
         expr = obj.expr
         sig = obj.signature
         if len(sig) == 1 and sig[0].is_symbol:
@@ -313,13 +1175,13 @@ class MathJsonPrinter(Printer):
 
     # TODO: Update
     def _print_LatticeOp(self, expr):
-        print("Warning: _print_LatticeOp was called")
+        self._warn("_print_LatticeOp", expr)
         args = sorted(expr.args, key=default_sort_key)
         return expr.func.__name__ + "(%s)" % ", ".join(self._print(arg) for arg in args)
 
     # TODO: Update
     def _print_Limit(self, expr):
-        print("Warning: _print_Limit was called")
+        self._warn("_print_Limit", expr)
         e, z, z0, dir = expr.args
         if str(dir) == "+":
             return "Limit(%s, %s, %s)" % tuple(map(self._print, (e, z, z0)))
@@ -331,37 +1193,38 @@ class MathJsonPrinter(Printer):
     def _print_list(self, expr):
         return self._function("List", [self._print(item) for item in expr], True)
 
-    # TODO: Update
     def _print_MatrixBase(self, expr):
-        print("Warning: _print_MatrixBase was called")
-        return expr._format_str(self)
+        elements = _matrix_elements(expr)
+        values = _machine_numbers(elements)
+        if values is not None:
+            # ["DenseMatrix", ["Tuple", rows, cols], ["List", ...row-major values]]
+            return self._function('DenseMatrix', [
+                self._function('Tuple', [self._integer(expr.rows), self._integer(expr.cols)]),
+                self._numbers(values)
+            ])
+
+        cols = expr.cols
+        rows = [
+            self._function('List', [self._print(element) for element in elements[i:i + cols]])
+            for i in range(0, len(elements), cols)
+        ] if cols else [self._function('List', []) for _ in range(expr.rows)]
+        return self._function('Matrix', [self._function('List', rows)])
 
-    # TODO: Update
     def _print_MatrixElement(self, expr):
-        print("Warning: _print_MatrixElement was called")
-        return self.parenthesize(expr.parent, PRECEDENCE["Atom"], strict=True) \
-            + '[%s, %s]' % (self._print(expr.i), self._print(expr.j))
+        # MathJson indices start at 1
+        return self._function('At', [self._print(expr.parent), self._print(expr.i + 1), self._print(expr.j + 1)])
 
-    # TODO: Update
     def _print_MatrixSlice(self, expr):
-        print("Warning: _print_MatrixSlice was called")
-        # TODO: Update
-        def strslice(x, dim):
-            x = list(x)
-            if x[2] == 1:
-                del x[2]
-            if x[0] == 0:
-                x[0] = ''
-            if x[1] == dim:
-                x[1] = ''
-            return ':'.join(map(lambda arg: self._print(arg), x))
-        return (self.parenthesize(expr.parent, PRECEDENCE["Atom"], strict=True) + '[' +
-                strslice(expr.rowslice, expr.parent.rows) + ', ' +
-                strslice(expr.colslice, expr.parent.cols) + ']')
+        # Zero based (start, stop, step) like in SymPy, since MathJson doesn't have slices
+        return self._function('MatrixSlice', [
+            self._print(expr.parent),
+            self._function('Tuple', [self._print(x) for x in expr.rowslice]),
+            self._function('Tuple', [self._print(x) for x in expr.colslice])
+        ])
 
     # TODO: Update
     def _print_DeferredVector(self, expr):
-        print("Warning: _print_DeferredVector was called")
+        self._warn("_print_DeferredVector", expr)
         return expr.name
 
     def _print_Mul(self, expr):
@@ -377,11 +1240,7 @@ class MathJsonPrinter(Printer):
         a = []  # items in the numerator
         b = []  # items that are in the denominator (if any)
 
-        if self.order not in ('old', 'none'):
-            args = expr.as_ordered_factors()
-        else:
-            # use make_args in case expr was something like -x -> x
-            args = Mul.make_args(expr)
+        args = self._ordered_args(expr)
 
         # Gather args for numerator/denominator
         for item in args:
@@ -414,7 +1273,7 @@ class MathJsonPrinter(Printer):
 
     # TODO: Update
     def _print_MatMul(self, expr):
-        print("Warning: _print_MatMul was called")
+        self._warn("_print_MatMul", expr)
         c, m = expr.as_coeff_mmul()
 
         sign = ""
@@ -433,7 +1292,7 @@ class MathJsonPrinter(Printer):
 
     # TODO: Update
     def _print_ElementwiseApplyFunction(self, expr):
-        print("Warning: _print_ElementwiseApplyFunction was called")
+        self._warn("_print_ElementwiseApplyFunction", expr)
         return "{0}.({1})".format(
             expr.function,
             self._print(expr.expr),
@@ -441,17 +1300,17 @@ class MathJsonPrinter(Printer):
 
     # TODO: Important Update
     def _print_NaN(self, expr):
-        print("Warning: _print_NaN was called")
+        self._warn("_print_NaN", expr)
         return 'nan'
 
     # TODO: Important Update
     def _print_NegativeInfinity(self, expr):
-        print("Warning: _print_NegativeInfinity was called")
+        self._warn("_print_NegativeInfinity", expr)
         return '-oo'
 
     # TODO: Update
     def _print_Order(self, expr):
-        print("Warning: _print_Order was called")
+        self._warn("_print_Order", expr)
         if not expr.variables or all(p is S.Zero for p in expr.point):
             if len(expr.variables) <= 1:
                 return 'O(%s)' % self._print(expr.expr)
@@ -462,17 +1321,17 @@ class MathJsonPrinter(Printer):
 
     # TODO: Update
     def _print_Ordinal(self, expr):
-        print("Warning: _print_Ordinal was called")
+        self._warn("_print_Ordinal", expr)
         return expr.__str__()
 
     # TODO: Update
     def _print_Cycle(self, expr):
-        print("Warning: _print_Cycle was called")
+        self._warn("_print_Cycle", expr)
         return expr.__str__()
 
     # TODO: Update
     def _print_Permutation(self, expr):
-        print("Warning: _print_Permutation was called")
+        self._warn("_print_Permutation", expr)
         from sympy.combinatorics.permutations import Permutation, Cycle
         from sympy.utilities.exceptions import SymPyDeprecationWarning
 
@@ -504,15 +1363,15 @@ class MathJsonPrinter(Printer):
                 if expr.size < 5:
                     return 'Permutation(%s)' % self._print(expr.array_form)
                 return 'Permutation([], size=%s)' % self._print(expr.size)
-            trim = self._print(expr.array_form[:s[-1] + 1]) + ', size=%s' % self._print(expr.size)
-            use = full = self._print(expr.array_form)
+            trim = self._str(self._print(expr.array_form[:s[-1] + 1])) + ', size=%s' % self._print(expr.size)
+            use = full = self._str(self._print(expr.array_form))
             if len(trim) < len(full):
                 use = trim
             return 'Permutation(%s)' % use
 
     # TODO: Update
     def _print_Subs(self, obj):
-        print("Warning: _print_Subs was called")
+        self._warn("_print_Subs", obj)
         expr, old, new = obj.args
         if len(obj.point) == 1:
             old = old[0]
@@ -522,22 +1381,22 @@ class MathJsonPrinter(Printer):
 
     # TODO: Update
     def _print_TensorIndex(self, expr):
-        print("Warning: _print_TensorIndex was called")
+        self._warn("_print_TensorIndex", expr)
         return expr._print()
 
     # TODO: Update
     def _print_TensorHead(self, expr):
-        print("Warning: _print_TensorHead was called")
+        self._warn("_print_TensorHead", expr)
         return expr._print()
 
     # TODO: Update
     def _print_Tensor(self, expr):
-        print("Warning: _print_Tensor was called")
+        self._warn("_print_Tensor", expr)
         return expr._print()
 
     # TODO: Update
     def _print_TensMul(self, expr):
-        print("Warning: _print_TensMul was called")
+        self._warn("_print_TensMul", expr)
         # prints expressions like "A(a)", "3*A(a)", "(1+x)*A(a)"
         sign, args = expr._get_args_for_traditional_printer()
         return sign + "*".join(
@@ -546,52 +1405,52 @@ class MathJsonPrinter(Printer):
 
     # TODO: Update
     def _print_TensAdd(self, expr):
-        print("Warning: _print_TensAdd was called")
+        self._warn("_print_TensAdd", expr)
         return expr._print()
 
     # TODO: Update
     def _print_PermutationGroup(self, expr):
-        print("Warning: _print_PermutationGroup was called")
+        self._warn("_print_PermutationGroup", expr)
         p = ['    %s' % self._print(a) for a in expr.args]
         return 'PermutationGroup([%s])' % ','.join(p)
 
     # TODO: Important Update
     def _print_Pi(self, expr):
-        print("Warning: _print_Pi was called")
-        return self._print('"Pi"')
+        self._warn("_print_Pi", expr)
+        return self._quotes('Pi')
 
     # TODO: Update
     def _print_PolyRing(self, ring):
-        print("Warning: _print_PolyRing was called")
+        self._warn("_print_PolyRing", ring)
         return "Polynomial ring in %s over %s with %s order" % \
             (", ".join(map(lambda rs: self._print(rs), ring.symbols)),
             self._print(ring.domain), self._print(ring.order))
 
     # TODO: Update
     def _print_FracField(self, field):
-        print("Warning: _print_FracField was called")
+        self._warn("_print_FracField", field)
         return "Rational function field in %s over %s with %s order" % \
             (", ".join(map(lambda fs: self._print(fs), field.symbols)),
             self._print(field.domain), self._print(field.order))
 
     # TODO: Update
     def _print_FreeGroupElement(self, elm):
-        print("Warning: _print_FreeGroupElement was called")
+        self._warn("_print_FreeGroupElement", elm)
         return elm.__str__()
 
     # TODO: Update
     def _print_GaussianElement(self, poly):
-        print("Warning: _print_GaussianElement was called")
+        self._warn("_print_GaussianElement", poly)
         return "(%s + %s*I)" % (poly.x, poly.y)
 
-    # TODO: Update
     def _print_PolyElement(self, poly):
-        print("Warning: _print_PolyElement was called")
-        return poly.str(self, PRECEDENCE, "%s**%s", "*")
+        if self._settings["polynomials"] == "expanded":
+            return self._print(poly.as_expr())
+        return self._print_polynomial(poly.ring.symbols, poly.terms(), poly.ring.domain)
 
     # TODO: Update
     def _print_FracElement(self, frac):
-        print("Warning: _print_FracElement was called")
+        self._warn("_print_FracElement", frac)
         if frac.denom == 1:
             return self._print(frac.numer)
         else:
@@ -599,82 +1458,33 @@ class MathJsonPrinter(Printer):
             denom = self.parenthesize(frac.denom, PRECEDENCE["Atom"], strict=True)
             return numer + "/" + denom
 
-    # TODO: Update
     def _print_Poly(self, expr):
-        print("Warning: _print_Poly was called")
-        ATOM_PREC = PRECEDENCE["Atom"] - 1
-        terms, gens = [], [ self.parenthesize(s, ATOM_PREC) for s in expr.gens ]
-
-        for monom, coeff in expr.terms():
-            s_monom = []
-
-            for i, exp in enumerate(monom):
-                if exp > 0:
-                    if exp == 1:
-                        s_monom.append(gens[i])
-                    else:
-                        s_monom.append(gens[i] + "**%d" % exp)
-
-            s_monom = "*".join(s_monom)
-
-            if coeff.is_Add:
-                if s_monom:
-                    s_coeff = "(" + self._print(coeff) + ")"
-                else:
-                    s_coeff = self._print(coeff)
-            else:
-                if s_monom:
-                    if coeff is S.One:
-                        terms.extend(['+', s_monom])
-                        continue
-
-                    if coeff is S.NegativeOne:
-                        terms.extend(['-', s_monom])
-                        continue
-
-                s_coeff = self._print(coeff)
-
-            if not s_monom:
-                s_term = s_coeff
-            else:
-                s_term = s_coeff + "*" + s_monom
-
-            if s_term.startswith('-'):
-                terms.extend(['-', s_term[1:]])
-            else:
-                terms.extend(['+', s_term])
-
-        if terms[0] in ['-', '+']:
-            modifier = terms.pop(0)
-
-            if modifier == '-':
-                terms[0] = '-' + terms[0]
-
-        format = expr.__class__.__name__ + "(%s, %s"
-
-        from sympy.polys.polyerrors import PolynomialError
-
-        try:
-            format += ", modulus=%s" % expr.get_modulus()
-        except PolynomialError:
-            format += ", domain='%s'" % expr.get_domain()
-
-        format += ")"
-
-        for index, item in enumerate(gens):
-            if len(item) > 2 and (item[:1] == "(" and item[len(item) - 1:] == ")"):
-                gens[index] = item[1:len(item) - 1]
-
-        return format % (' '.join(terms), ', '.join(gens))
+        if self._settings["polynomials"] == "expanded":
+            return self._print(expr.as_expr())
+        return self._print_polynomial(expr.gens, expr.rep.terms(), expr.rep.dom)
+
+    def _print_polynomial(self, gens, terms, domain):
+        """
+        Prints the generators, the exponent vectors of all terms one after another and the coefficients,
+        without building an expression for every term
+        """
+        exponents = [exponent for monom, _ in terms for exponent in monom]
+        coefficients = [domain.to_sympy(coefficient) for _, coefficient in terms]
+        values = _machine_numbers(coefficients)
+        return self._function("Polynomial", [
+            self._function("List", [self._print(gen) for gen in gens]),
+            self._numbers(exponents),
+            self._numbers(values) if values is not None else self._function("List", [self._print(c) for c in coefficients]),
+        ])
 
     # TODO: Update
     def _print_UniversalSet(self, p):
-        print("Warning: _print_UniversalSet was called")
+        self._warn("_print_UniversalSet", p)
         return 'UniversalSet'
 
     # TODO: Update
     def _print_AlgebraicNumber(self, expr):
-        print("Warning: _print_AlgebraicNumber was called")
+        self._warn("_print_AlgebraicNumber", expr)
         if expr.is_aliased:
             return self._print(expr.as_poly().as_expr())
         else:
@@ -703,108 +1513,114 @@ class MathJsonPrinter(Printer):
 
     # TODO: Update
     def _print_UnevaluatedExpr(self, expr):
-        print("Warning: _print_UnevaluatedExpr was called")
+        self._warn("_print_UnevaluatedExpr", expr)
         return self._print(expr.args[0])
 
     # TODO: Update
     def _print_MatPow(self, expr):
-        print("Warning: _print_MatPow was called")
+        self._warn("_print_MatPow", expr)
         PREC = precedence(expr)
         return '%s**%s' % (self.parenthesize(expr.base, PREC, strict=False),
                          self.parenthesize(expr.exp, PREC, strict=False))
 
     def _print_Integer(self, expr):
-        return str(expr.p)
+        return self._integer(expr.p)
 
     # TODO: Update
     def _print_Integers(self, expr):
-        print("Warning: _print_Integers was called")
+        self._warn("_print_Integers", expr)
         return 'Integers'
 
     # TODO: Update
     def _print_Naturals(self, expr):
-        print("Warning: _print_Naturals was called")
+        self._warn("_print_Naturals", expr)
         return 'Naturals'
 
     # TODO: Update
     def _print_Naturals0(self, expr):
-        print("Warning: _print_Naturals0 was called")
+        self._warn("_print_Naturals0", expr)
         return 'Naturals0'
 
     # TODO: Update
     def _print_Rationals(self, expr):
-        print("Warning: _print_Rationals was called")
+        self._warn("_print_Rationals", expr)
         return 'Rationals'
 
     # TODO: Update
     def _print_Reals(self, expr):
-        print("Warning: _print_Reals was called")
+        self._warn("_print_Reals", expr)
         return 'Reals'
 
     # TODO: Update
     def _print_Complexes(self, expr):
-        print("Warning: _print_Complexes was called")
+        self._warn("_print_Complexes", expr)
         return 'Complexes'
 
     # TODO: Update
     def _print_EmptySet(self, expr):
-        print("Warning: _print_EmptySet was called")
+        self._warn("_print_EmptySet", expr)
         return 'EmptySet'
 
     # TODO: Update
     def _print_EmptySequence(self, expr):
-        print("Warning: _print_EmptySequence was called")
+        self._warn("_print_EmptySequence", expr)
         return 'EmptySequence'
 
     # TODO: Update
     def _print_int(self, expr):
-        print("Warning: _print_int was called")
-        return str(expr)
+        self._warn("_print_int", expr)
+        return self._integer(expr)
 
     # TODO: Update
     def _print_mpz(self, expr):
-        print("Warning: _print_mpz was called")
-        return str(expr)
+        self._warn("_print_mpz", expr)
+        return self._integer(int(expr))
 
     def _print_Rational(self, expr):
         if expr.q == 1:
-            return str(expr.p)
+            return self._integer(expr.p)
         else:
-            return self._function('Divide', [str(expr.p), str(expr.q)])
+            return self._function('Divide', [self._integer(expr.p), self._integer(expr.q)])
 
     def _print_PythonRational(self, expr):
         if expr.q == 1:
-            return str(expr.p)
+            return self._integer(expr.p)
         else:
-            return self._function('Divide', [str(expr.p), str(expr.q)])
+            return self._function('Divide', [self._integer(expr.p), self._integer(expr.q)])
 
     def _print_Fraction(self, expr):
         if expr.denominator == 1:
-            return str(expr.numerator)
+            return self._integer(expr.numerator)
         else:
-            return self._function('Divide', [str(expr.numerator), str(expr.denominator)])
+            return self._function('Divide', [self._integer(expr.numerator), self._integer(expr.denominator)])
 
     def _print_mpq(self, expr):
         if expr.denominator == 1:
-            return str(expr.numerator)
+            return self._integer(expr.numerator)
         else:
-            return self._function('Divide', [str(expr.numerator), str(expr.denominator)])
+            return self._function('Divide', [self._integer(expr.numerator), self._integer(expr.denominator)])
 
     def _print_Float(self, expr):
+        full_prec, low, high = self._float_settings
+        if full_prec is True:
+            strip = False
+        elif full_prec is False:
+            strip = True
+        elif full_prec == "auto":
+            strip = self._print_level > 1
+
+        # Machine precision floats, like the ones from evalf()
+        if expr._prec == 53 and expr._mpf_[1]:
+            rv = _format_double(mlib_to_float(expr._mpf_), strip, low, high)
+            if rv is not None:
+                return self._float(rv)
+
         # Precision
         prec = expr._prec
         if prec < 5:
             dps = 0
         else:
             dps = prec_to_dps(expr._prec)
-        if self._settings["full_prec"] is True:
-            strip = False
-        elif self._settings["full_prec"] is False:
-            strip = True
-        elif self._settings["full_prec"] == "auto":
-            strip = self._print_level > 1
-        low = self._settings["min"] if "min" in self._settings else None
-        high = self._settings["max"] if "max" in self._settings else None
         rv = mlib_to_str(expr._mpf_, dps, strip_zeros=strip, min_fixed=low, max_fixed=high)
         if rv.startswith('-.0'):
             rv = '-0.' + rv[3:]
@@ -813,7 +1629,7 @@ class MathJsonPrinter(Printer):
         if rv.startswith('+'):
             # e.g., +inf -> inf
             rv = rv[1:]
-        return rv
+        return self._float(rv)
 
     def _print_Relational(self, expr):
 
@@ -831,20 +1647,20 @@ class MathJsonPrinter(Printer):
         if expr.rel_op in charmap:
             return self._function(charmap[expr.rel_op], [self._print(expr.lhs), self._print(expr.rhs)])
 
-        print("Warning: _print_Relational was called")
+        self._warn("_print_Relational", expr)
         return '%s %s %s' % (self.parenthesize(expr.lhs, precedence(expr)),
                            self._relationals.get(expr.rel_op) or expr.rel_op,
                            self.parenthesize(expr.rhs, precedence(expr)))
 
     # TODO: Update
     def _print_ComplexRootOf(self, expr):
-        print("Warning: _print_ComplexRootOf was called")
+        self._warn("_print_ComplexRootOf", expr)
         return "CRootOf(%s, %d)" % (self._print_Add(expr.expr,  order='lex'),
                                     expr.index)
 
     # TODO: Update
     def _print_RootSum(self, expr):
-        print("Warning: _print_RootSum was called")
+        self._warn("_print_RootSum", expr)
         args = [self._print_Add(expr.expr, order='lex')]
 
         if expr.fun is not S.IdentityFunction:
@@ -854,7 +1670,7 @@ class MathJsonPrinter(Printer):
 
     # TODO: Update
     def _print_GroebnerBasis(self, basis):
-        print("Warning: _print_GroebnerBasis was called")
+        self._warn("_print_GroebnerBasis", basis)
         cls = basis.__class__.__name__
 
         exprs = [self._print_Add(arg, order=basis.order) for arg in basis.exprs]
@@ -870,7 +1686,7 @@ class MathJsonPrinter(Printer):
 
     # TODO: Update
     def _print_set(self, s):
-        print("Warning: _print_set was called")
+        self._warn("_print_set", s)
         items = sorted(s, key=default_sort_key)
 
         args = ', '.join(self._print(item) for item in items)
@@ -880,14 +1696,14 @@ class MathJsonPrinter(Printer):
 
     # TODO: Update
     def _print_frozenset(self, s):
-        print("Warning: _print_frozenset was called")
+        self._warn("_print_frozenset", s)
         if not s:
             return "frozenset()"
         return "frozenset(%s)" % self._print_set(s)
 
     # TODO: Update
     def _print_Sum(self, expr):
-        print("Warning: _print_Sum was called")
+        self._warn("_print_Sum", expr)
         # TODO: Update
         def _xab_tostr(xab):
             if len(xab) == 1:
@@ -898,38 +1714,40 @@ class MathJsonPrinter(Printer):
         return 'Sum(%s, %s)' % (self._print(expr.function), L)
 
     def _print_Symbol(self, expr):
+        if self._name_table is not None:
+            return self._quotes(self._name_table.decode(expr.name))
         return self._quotes(expr.name)
     _print_MatrixSymbol = _print_Symbol
     _print_RandomSymbol = _print_Symbol
 
     # TODO: Update
     def _print_Identity(self, expr):
-        print("Warning: _print_Identity was called")
+        self._warn("_print_Identity", expr)
         return "I"
 
     # TODO: Update
     def _print_ZeroMatrix(self, expr):
-        print("Warning: _print_ZeroMatrix was called")
+        self._warn("_print_ZeroMatrix", expr)
         return "0"
 
     # TODO: Update
     def _print_OneMatrix(self, expr):
-        print("Warning: _print_OneMatrix was called")
+        self._warn("_print_OneMatrix", expr)
         return "1"
 
     # TODO: Update
     def _print_Predicate(self, expr):
-        print("Warning: _print_Predicate was called")
+        self._warn("_print_Predicate", expr)
         return "Q.%s" % expr.name
 
     # TODO: Update
     def _print_str(self, expr):
-        print("Warning: _print_str was called")
+        self._warn("_print_str", expr)
         return str(expr)
 
     # TODO: Update
     def _print_tuple(self, expr):
-        print("Warning: _print_tuple was called")
+        self._warn("_print_tuple", expr)
         if len(expr) == 1:
             return "(%s,)" % self._print(expr[0])
         else:
@@ -937,123 +1755,109 @@ class MathJsonPrinter(Printer):
 
     # TODO: Update
     def _print_Tuple(self, expr):
-        print("Warning: _print_Tuple was called")
+        self._warn("_print_Tuple", expr)
         return self._print_tuple(expr)
 
     # TODO: Update
     def _print_Transpose(self, T):
-        print("Warning: _print_Transpose was called")
+        self._warn("_print_Transpose", T)
         return "%s.T" % self.parenthesize(T.arg, PRECEDENCE["Pow"])
 
     # TODO: Update
     def _print_Uniform(self, expr):
-        print("Warning: _print_Uniform was called")
+        self._warn("_print_Uniform", expr)
         return "Uniform(%s, %s)" % (self._print(expr.a), self._print(expr.b))
 
     # TODO: Update
     def _print_Quantity(self, expr):
-        print("Warning: _print_Quantity was called")
+        self._warn("_print_Quantity", expr)
         return "%s" % expr.name
 
     # TODO: Update
     def _print_Quaternion(self, expr):
-        print("Warning: _print_Quaternion was called")
+        self._warn("_print_Quaternion", expr)
         s = [self.parenthesize(i, PRECEDENCE["Mul"], strict=True) for i in expr.args]
         a = [s[0]] + [i+"*"+j for i, j in zip(s[1:], "ijk")]
         return " + ".join(a)
 
     # TODO: Update
     def _print_Dimension(self, expr):
-        print("Warning: _print_Dimension was called")
+        self._warn("_print_Dimension", expr)
         return str(expr)
 
     # TODO: Update
     def _print_Wild(self, expr):
-        print("Warning: _print_Wild was called")
+        self._warn("_print_Wild", expr)
         return expr.name + '_'
 
     # TODO: Update
     def _print_WildFunction(self, expr):
-        print("Warning: _print_WildFunction was called")
+        self._warn("_print_WildFunction", expr)
         return expr.name + '_'
 
     # TODO: Update
     def _print_Zero(self, expr):
-        print("Warning: _print_Zero was called")
-        return "0"
+        self._warn("_print_Zero", expr)
+        return self._integer(0)
 
-    # TODO: Update
     def _print_DMP(self, p):
-        print("Warning: _print_DMP was called")
-        from sympy.core.sympify import SympifyError
-        try:
-            if p.ring is not None:
-                # TODO incorporate order
-                return self._print(p.ring.to_sympy(p))
-        except SympifyError:
-            pass
-
-        cls = p.__class__.__name__
-        rep = self._print(p.rep)
-        dom = self._print(p.dom)
-        ring = self._print(p.ring)
-
-        return "%s(%s, %s, %s)" % (cls, rep, dom, ring)
+        if self._settings["polynomials"] == "expanded" and p.ring is not None:
+            return self._print(p.ring.to_sympy(p))
+        # Without a ring, the generators are unknown. There are len(exponents) / len(coefficients) of them
+        return self._print_polynomial(getattr(p.ring, 'symbols', ()), p.terms(), p.dom)
 
-    # TODO: Update
     def _print_DMF(self, expr):
-        print("Warning: _print_DMF was called")
-        return self._print_DMP(expr)
+        return self._function("Divide", [self._print_DMP(expr.numer()), self._print_DMP(expr.denom())])
 
     # TODO: Update
     def _print_Object(self, obj):
-        print("Warning: _print_Object was called")
+        self._warn("_print_Object", obj)
         return 'Object("%s")' % obj.name
 
     # TODO: Update
     def _print_IdentityMorphism(self, morphism):
-        print("Warning: _print_IdentityMorphism was called")
+        self._warn("_print_IdentityMorphism", morphism)
         return 'IdentityMorphism(%s)' % morphism.domain
 
     # TODO: Update
     def _print_NamedMorphism(self, morphism):
-        print("Warning: _print_NamedMorphism was called")
+        self._warn("_print_NamedMorphism", morphism)
         return 'NamedMorphism(%s, %s, "%s")' % \
                (morphism.domain, morphism.codomain, morphism.name)
 
     # TODO: Update
     def _print_Category(self, category):
-        print("Warning: _print_Category was called")
+        self._warn("_print_Category", category)
         return 'Category("%s")' % category.name
 
     # TODO: Update
     def _print_Manifold(self, manifold):
-        print("Warning: _print_Manifold was called")
+        self._warn("_print_Manifold", manifold)
         return manifold.name.name
 
     # TODO: Update
     def _print_Patch(self, patch):
-        print("Warning: _print_Patch was called")
+        self._warn("_print_Patch", patch)
         return patch.name.name
 
     # TODO: Update
     def _print_CoordSystem(self, coords):
-        print("Warning: _print_CoordSystem was called")
+        self._warn("_print_CoordSystem", coords)
         return coords.name.name
 
     # TODO: Update
     def _print_BaseScalarField(self, field):
-        print("Warning: _print_BaseScalarField was called")
+        self._warn("_print_BaseScalarField", field)
         return field._coord_sys.symbols[field._index].name
 
     # TODO: Update
     def _print_BaseVectorField(self, field):
-        print("Warning: _print_BaseVectorField was called")
+        self._warn("_print_BaseVectorField", field)
         return 'e_%s' % field._coord_sys.symbols[field._index].name
 
     # TODO: Update
     def _print_Differential(self, diff):
-        print("Warning: _print_Differential was called")
+        self._warn("_print_Differential", diff)
         field = diff._form_field
         if hasattr(field, '_coord_sys'):
             return 'd%s' % field._coord_sys.symbols[field._index].name
@@ -1062,11 +1866,436 @@ class MathJsonPrinter(Printer):
 
     # TODO: Update
     def _print_Tr(self, expr):
-        print("Warning: _print_Tr was called")
+        self._warn("_print_Tr", expr)
         #TODO : Handle indices
         return "%s(%s)" % ("Tr", self._print(expr.args[0]))
 
     # TODO: Update
     def _print_Str(self, s):
-        print("Warning: _print_Str was called")
-        return self._print(s.name)
\ No newline at end of file
+        self._warn("_print_Str", s)
+        return self._print(s.name)
+
+class MathJsonTreePrinter(MathJsonPrinter):
+    """
+    A MathJsonPrinter which builds the MathJson as plain lists, strings and numbers.
+
+    Nested function calls don't get re-copied into their parent's string. Instead,
+    the finished tree is serialized exactly once by `doprint`. Alternatively, `totree`
+    returns the tree itself, which Pyodide can directly convert to Javascript objects.
+    """
+
+    def _quotes(self, text):
+        return text
+
+    def _integer(self, value):
+        value = int(value)
+        if -_max_exact_float <= value <= _max_exact_float:
+            return value
+        # Javascript numbers can't represent larger integers exactly
+        return {"num": _integer_text(value, self._settings["max_integer_digits"])}
+
+    def _float(self, text):
+        value = float(text)
+        if math.isfinite(value) and (value != 0 or text.lstrip('-').split('e')[0].strip('0.') == ''):
+            return value
+        # JSON doesn't have infinity or NaN
+        special = {"inf": "+Infinity", "-inf": "-Infinity", "nan": "NaN"}.get(text)
+        if special is not None:
+            return {"num": special}
+        # Finite, but outside of the range of doubles, e.g. 1e400 or 1e-400
+        return {"num": text}
+
+    def _function(self, name, args, requires_multiple_args=False):
+        if requires_multiple_args and len(args) == 1:
+            return args[0]
+        else:
+            return [name, *args]
+
+    def _numbers(self, values):
+        return ["List", *values]
+
+    def totree(self, expr):
+        return self._print_root(expr)
+
+    def doprint(self, expr):
+        return self.dumps(self.totree(expr))
+
+    def dumps(self, tree):
+        try:
+            return json.dumps(tree, separators=(',', ':'))
+        except RecursionError:
+            if not self._settings["iterative"]:
+                raise
+            # Only for trees which are too deep for json.dumps, which writes one token at a time
+            return _dumps_iteratively(tree)
+
+
+# Types which json.dumps can write without recursing
+_flat_types = (str, int, float)
+
+
+def expand_shared(tree):
+    """
+    Replaces the references in a ["Shared", ["List", ...definitions], body] tree with their definitions.
+    The expanded definitions are not copied, so the result can contain the same list more than once.
+    """
+    if not (isinstance(tree, list) and len(tree) == 3 and tree[0] == "Shared"):
+        return tree
+    definitions = []
+    for definition in tree[1][1:]:
+        definitions.append(_replace_references(definition, definitions))
+    return _replace_references(tree[2], definitions)
+
+
+def _is_reference(item):
+    return isinstance(item, list) and len(item) == 2 and item[0] == "Ref" and type(item[1]) is int
+
+
+def _replace_references(tree, definitions):
+    if _is_reference(tree):
+        return definitions[tree[1]]
+    if not isinstance(tree, list):
+        return tree
+    result = list(tree)
+    stack = [result]
+    while stack:
+        node = stack.pop()
+        for i in range(1, len(node)):
+            child = node[i]
+            if _is_reference(child):
+                node[i] = definitions[child[1]]
+            elif isinstance(child, list):
+                node[i] = list(child)
+                stack.append(node[i])
+    return result
+
+
+def _dumps_iteratively(tree):
+    """
+    Serializes a tree of lists and dictionaries to the same JSON as json.dumps(tree, separators=(',', ':')),
+    without recursing into them.
+    """
+    chunks = []
+    # Either a tree or a piece of raw JSON text
+    stack = [(tree, False)]
+    while stack:
+        item, is_raw = stack.pop()
+        if is_raw:
+            chunks.append(item)
+        elif isinstance(item, list):
+            if all(type(child) in _flat_types for child in item):
+                # e.g. the values of a dense matrix
+                chunks.append(json.dumps(item, separators=(',', ':')))
+                continue
+            chunks.append('[')
+            stack.append((']', True))
+            for i in range(len(item) - 1, 0, -1):
+                stack.append((item[i], False))
+                stack.append((',', True))
+            stack.append((item[0], False))
+        elif isinstance(item, dict):
+            if not item:
+                chunks.append('{}')
+                continue
+            chunks.append('{')
+            stack.append(('}', True))
+            entries = list(item.items())
+            for i in range(len(entries) - 1, -1, -1):
+                key, value = entries[i]
+                stack.append((value, False))
+                stack.append((json.dumps(str(key)) + ':', True))
+                if i > 0:
+                    stack.append((',', True))
+        else:
+            chunks.append(json.dumps(item, separators=(',', ':')))
+    return ''.join(chunks)
+
+
+class _Subtree:
+    """
+    Stands in for a child while its parent gets printed by itself
+    """
+
+    __slots__ = ("node", "path")
+
+    def __init__(self, node, path):
+        self.node = node
+        self.path = path
+
+
+class MathJsonStreamWriter:
+    """
+    Writes MathJson in chunks, without building the whole printed tree or string first.
+
+    Every node gets printed by itself, with its children standing in as _Subtree markers, which
+    only get printed once the writer reaches them. With a budget, subtrees which don't fit get
+    replaced by placeholders, which record where they are and how many nodes they have
+    - ["Elided", ["List", *path], size] for the subtree at path, a list of argument indices
+    - ["Elided", ["List", *path], size, ["List", *index]] for the rest of a list in the printed
+      subtree at path, starting with the item at index
+    `fetch` writes the contents of a placeholder, with the same budget.
+
+    max_nodes limits the number of nodes, which get chosen breadth first so that the top of the tree stays visible.
+    max_bytes is checked while writing, so the closing brackets and placeholders can exceed it.
+    """
+
+    def __init__(self, settings=None, max_nodes=None, max_bytes=None, chunk_size=1 << 16):
+        settings = dict(settings or {})
+        self._printer = MathJsonTreePrinter(settings)
+        # A cached subtree would contain the full children instead of the markers
+        settings["print_cache"] = None
+        self._shallow_printer = MathJsonTreePrinter(settings)
+        self.max_nodes = max_nodes
+        self.max_bytes = max_bytes
+        self.chunk_size = chunk_size
+        self._cancellation = settings.get("cancellation")
+        # Number of placeholders in the last output
+        self.elided = 0
+
+    def dumps(self, expr):
+        saved = self._begin_deep(expr)
+        try:
+            sizes = self._count(expr)
+            if self.max_bytes is None and (self.max_nodes is None or sizes[id(expr)] <= self.max_nodes):
+                # Fits anyways, so the printed subtrees can come from the cache
+                self.elided = 0
+                return self._printer.doprint(expr)
+            return ''.join(self._write(expr, [], None, sizes))
+        finally:
+            self._end_deep(saved)
+
+    def iterchunks(self, expr):
+        saved = self._begin_deep(expr)
+        try:
+            yield from self._write(expr, [], None, None)
+        finally:
+            self._end_deep(saved)
+
+    def write(self, expr, file):
+        for chunk in self.iterchunks(expr):
+            file.write(chunk)
+
+    def fetch(self, expr, path, index=None):
+        """
+        Writes the contents of a placeholder of expr. The rest of a list gets written as ["Sequence", ...]
+        """
+        # Decided by the whole expression, so that the placeholders of dumps still point at the same items
+        saved = self._begin_deep(expr)
+        try:
+            node = expr
+            for i in path:
+                node = _subtree_children(node)[i]
+            return ''.join(self._write(node, list(path), index, None))
+        finally:
+            self._end_deep(saved)
+
+    def _begin_deep(self, expr):
+        """
+        Both printers have to agree on the ordering, see MathJsonPrinter._begin_deep
+        """
+        saved = self._printer._begin_deep(expr)
+        if saved is None:
+            return None
+        return saved, self._shallow_printer._begin_deep(expr, like=self._printer)
+
+    def _end_deep(self, saved):
+        if saved is not None:
+            self._printer._end_deep(saved[0])
+            self._shallow_printer._end_deep(saved[1])
+
+    def _write(self, node, path, index, sizes):
+        if sizes is None:
+            sizes = self._count(node)
+        self.elided = 0
+        owner = _Subtree(node, path)
+        if index is None:
+            kept = self._choose([node])
+            stack = [(_VALUE, owner, None, None)]
+        else:
+            container = self._print_shallow(owner)
+            for i in index[:-1]:
+                container = container[i]
+            items = container[index[-1]:]
+            kept = self._choose([subtree.node for subtree in _markers(items)])
+            # The head of the sequence shifts the indices by one
+            stack = [(_LIST, ["Sequence", *items], 0, (owner, list(index[:-1]), index[-1] - 1))]
+
+        max_bytes = self.max_bytes
+        chunk_size = self.chunk_size
+        buffer = []
+        buffered = 0
+        written = 0
+        expanded = 0
+
+        def fits(subtree):
+            # The first subtree always gets written, so that fetching a placeholder makes progress
+            return (kept is None or kept.get(id(subtree.node), False)) and (max_bytes is None or written < max_bytes or not expanded)
+
+        def has_placeholder(subtree):
+            return kept is not None and id(subtree.node) in kept and (max_bytes is None or written < max_bytes)
+
+        cancellation = self._cancellation
+        while stack:
+            if cancellation is not None:
+                cancellation.tick()
+            kind, item, position, context = stack.pop()
+            if kind is _VALUE:
+                if isinstance(item, _Subtree):
+                    if fits(item):
+                        expanded += 1
+                        stack.append((_VALUE, self._print_shallow(item), None, (item, [])))
+                        continue
+                    text = self._placeholder(item.path, self._size(item, sizes))
+                elif isinstance(item, list) and not all(type(child) in _flat_types for child in item):
+                    owner, tree_path = context
+                    stack.append((_LIST, item, 0, (owner, tree_path, 0)))
+                    continue
+                else:
+                    text = json.dumps(item, separators=(',', ':'))
+            else:
+                owner, tree_path, offset = context
+                if position >= len(item):
+                    text = ']' if item else '[]'
+                else:
+                    child = item[position]
+                    text = ',' if position > 0 else '['
+                    if isinstance(child, _Subtree) and len(item) - position > 1 and not fits(child) and not has_placeholder(child):
+                        # One placeholder for the rest of the list, instead of one per item
+                        text += self._placeholder(
+                            owner.path, self._size(item[position:], sizes), tree_path + [position + offset]
+                        ) + ']'
+                    else:
+                        stack.append((_LIST, item, position + 1, context))
+                        stack.append((_VALUE, child, None, (owner, tree_path + [position + offset])))
+
+            buffer.append(text)
+            buffered += len(text)
+            written += len(text)
+            if buffered >= chunk_size:
+                yield ''.join(buffer)
+                buffer = []
+                buffered = 0
+
+        if buffer:
+            yield ''.join(buffer)
+        diagnostics.report()
+
+    def _placeholder(self, path, size, index=None):
+        self.elided += 1
+        placeholder = ["Elided", ["List", *path], size]
+        if index is not None:
+            placeholder.append(["List", *index])
+        return json.dumps(placeholder, separators=(',', ':'))
+
+    def _print_shallow(self, subtree):
+        node, path = subtree.node, subtree.path
+        printer = self._shallow_printer
+        children = _subtree_children(node)
+        markers = dict()
+        # Some printing methods skip a level, e.g. _print_Mul prints the bases of negative powers
+        for i, child in enumerate(children):
+            for j, grandchild in enumerate(_subtree_children(child)):
+                markers.setdefault(id(grandchild), _Subtree(grandchild, path + [i, j]))
+        for i, child in enumerate(children):
+            markers[id(child)] = _Subtree(child, path + [i])
+
+        printer._printed_subtrees = markers
+        # Only the root of the whole expression is at the top level
+        printer._print_level = 0 if not path else 1
+        try:
+            return printer._print(node)
+        finally:
+            printer._print_level = 0
+            printer._printed_subtrees = None
+
+    def _count(self, expr):
+        """
+        Counts the nodes of every subtree, bottom up and without recursion
+        """
+        sizes = dict()
+        cancellation = self._cancellation
+        stack = [(expr, False)]
+        while stack:
+            if cancellation is not None:
+                cancellation.tick()
+            node, children_counted = stack.pop()
+            if id(node) in sizes:
+                continue
+            children = _subtree_children(node)
+            if not children_counted:
+                stack.append((node, True))
+                for child in children:
+                    if id(child) not in sizes:
+                        stack.append((child, False))
+            else:
+                sizes[id(node)] = 1 + sum(sizes[id(child)] for child in children)
+        return sizes
+
+    def _choose(self, roots):
+        """
+        Decides which nodes fit into max_nodes. Returns a dictionary from the ids of the nodes that get written
+        to whether they get expanded or replaced by their own placeholder, or None without a limit.
+
+        Nodes get expanded breadth first, where every child of an expanded node counts as one node.
+        The first root always gets expanded, as far as possible.
+        """
+        if self.max_nodes is None:
+            return None
+        kept = dict()
+        count = len(roots)
+        queue = deque()
+        for root in roots:
+            if _subtree_children(root):
+                kept[id(root)] = False
+                queue.append(root)
+            else:
+                kept[id(root)] = True
+        first = True
+        while queue:
+            node = queue.popleft()
+            children = _subtree_children(node)
+            if kept[id(node)] or (not first and count + len(children) > self.max_nodes):
+                continue
+            first = False
+            kept[id(node)] = True
+            if count + len(children) > self.max_nodes:
+                # Only some of the children fit, so take the ones that get printed first
+                children = self._printed_children(node)[:max(self.max_nodes - count, 0)]
+            for child in children:
+                if id(child) in kept:
+                    continue
+                count += 1
+                if _subtree_children(child):
+                    kept[id(child)] = False
+                    queue.append(child)
+                else:
+                    # Leaves don't need to be expanded
+                    kept[id(child)] = True
+        return kept
+
+    def _printed_children(self, node):
+        children = set(map(id, _subtree_children(node)))
+        return [subtree.node for subtree in _markers([self._print_shallow(_Subtree(node, []))]) if id(subtree.node) in children]
+
+    def _size(self, item, sizes):
+        return sum(sizes.get(id(subtree.node), 1) for subtree in _markers([item]))
+
+
+def _markers(items):
+    """
+    Returns the _Subtree markers in a printed tree, in order
+    """
+    markers = []
+    stack = list(reversed(items))
+    while stack:
+        item = stack.pop()
+        if isinstance(item, _Subtree):
+            markers.append(item)
+        elif isinstance(item, list):
+            stack.extend(reversed(item))
+    return markers
+
+
+# Kinds of entries on the stack of MathJsonStreamWriter._write
+_VALUE = "value"
+_LIST = "list"
@@ -0,0 +1,164 @@
+"""
+A Builder which converts a MathJson expression into its SymPy equivalent.
+"""
+
+import decimal
+
+import sympy.functions
+from sympy.core import S, Add, Mul, Pow, Integer, Rational
+from sympy.core.function import Function, FunctionClass
+from sympy.core.relational import Eq
+from sympy.matrices import ImmutableMatrix
+from sympy.polys.polytools import Poly
+
+from mathjson import _known_functions_mathjson, symbol_registry
+
+
+def _inverse_known_functions():
+    functions = dict()
+    for name, mathjson_name in _known_functions_mathjson.items():
+        function = getattr(sympy.functions, name, None)
+        if isinstance(function, FunctionClass):
+            # The first entry wins, e.g. 'log' instead of 'ln'
+            functions.setdefault(mathjson_name, function)
+    return functions
+
+
+_mathjson_functions = _inverse_known_functions()
+_mathjson_functions.update({
+    'Add': Add,
+    'Multiply': Mul,
+    'Power': Pow,
+    'Sqrt': sympy.functions.sqrt,
+    'Root': sympy.functions.root,
+    'EqualEqual': Eq,
+    'Abs': sympy.functions.Abs,
+    'Acoth': sympy.functions.acoth,
+})
+
+_mathjson_constants = {
+    'Pi': S.Pi,
+    'ExponentialE': S.Exp1,
+    'ImaginaryUnit': S.ImaginaryUnit,
+    'GoldenRatio': S.GoldenRatio,
+    'EulerGamma': S.EulerGamma,
+    'CatalanConstant': S.Catalan,
+}
+
+
+class MathJsonBuilder:
+    """
+    Builds SymPy objects directly from parsed MathJson, without generating any Python code.
+
+    Symbol names in the MathJson are encoded, and so are the names of the built symbols.
+    Printers with a NameTable decode them again, see the "name_table" setting.
+    The symbols come from a SymbolRegistry, so every builder of a session shares them.
+    """
+
+    _functions = _mathjson_functions
+    _constants = _mathjson_constants
+
+    def __init__(self, symbols=symbol_registry):
+        self._symbols = symbols
+        # The built definitions of the ["Shared", ...] expression that is currently being built
+        self._shared = None
+
+    def build(self, expression):
+        if isinstance(expression, list):
+            return self._build_function(expression[0], expression[1:])
+        elif isinstance(expression, str):
+            return self._build_string(expression)
+        elif isinstance(expression, bool):
+            raise ValueError("Expression cannot contain booleans")
+        elif isinstance(expression, int):
+            return Integer(expression)
+        elif isinstance(expression, float):
+            return Rational(expression)
+        elif expression is None:
+            return None
+        elif isinstance(expression, dict) and "num" in expression:
+            return self._build_number(expression["num"])
+        else:
+            raise ValueError("Unknown MathJson element %r" % (expression,))
+
+    def symbol(self, name):
+        return self._symbols.symbol(name)
+
+    def function(self, name):
+        """
+        Looks up a function by its MathJson name or its SymPy name, e.g. for rewrite(sin)
+        """
+        function = self._functions.get(name)
+        if function is None:
+            function = getattr(sympy.functions, name, None)
+        if not isinstance(function, FunctionClass):
+            raise ValueError("Unknown function %s" % name)
+        return function
+
+    def _build_string(self, name):
+        constant = self._constants.get(name)
+        if constant is not None:
+            return constant
+        return self.symbol(name)
+
+    def _build_number(self, text):
+        if isinstance(text, str):
+            text = text.strip()
+            if len(text) > 4000 and text.lstrip('+-').isdigit():
+                # Converting long strings to int is quadratic and limited to 4300 digits on newer Pythons
+                return Integer(int(decimal.Decimal(text)))
+        value = Rational(text)
+        return Integer(value.p) if value.q == 1 else value
+
+    def _build_function(self, head, args):
+        if head == 'Subtract':
+            # a - b == a + (-b)
+            if len(args) == 1:
+                return Mul(self.build(args[0]), S.NegativeOne)
+            return Add(self.build(args[0]), Mul(self.build(args[1]), S.NegativeOne))
+        elif head == 'Negate':
+            # -a == a * -1
+            return Mul(self.build(args[0]), S.NegativeOne)
+        elif head == 'Divide':
+            # Special case for simple fractions
+            if all(isinstance(arg, (int, float)) and not isinstance(arg, bool) for arg in args):
+                return Rational(args[0], args[1])
+            # a / b == a * b^(-1)
+            return Mul(self.build(args[0]), Pow(self.build(args[1]), S.NegativeOne))
+        elif head == 'Parentheses':
+            return self.build(args[0])
+        elif head == 'Polynomial':
+            # ["Polynomial", ["List", ...generators], ["List", ...exponents], ["List", ...coefficients]]
+            gens = [self.build(gen) for gen in args[0][1:]]
+            exponents = args[1][1:]
+            terms = {
+                tuple(exponents[i * len(gens):(i + 1) * len(gens)]): self.build(coefficient)
+                for i, coefficient in enumerate(args[2][1:])
+            }
+            return Poly.from_dict(terms, *gens)
+        elif head == 'Shared':
+            # ["Shared", ["List", ...definitions], body], where ["Ref", i] stands for the i-th definition
+            outer = self._shared
+            self._shared = []
+            try:
+                for definition in args[0][1:]:
+                    self._shared.append(self.build(definition))
+                return self.build(args[1])
+            finally:
+                self._shared = outer
+        elif head == 'Ref' and self._shared is not None:
+            return self._shared[args[0]]
+        elif head == 'Matrix':
+            # ["Matrix", ["List", ["List", ...row], ...]]
+            return ImmutableMatrix([[self.build(element) for element in row[1:]] for row in args[0][1:]])
+        elif head == 'DenseMatrix':
+            # ["DenseMatrix", ["Tuple", rows, cols], ["List", ...row-major values]]
+            rows, cols = args[0][1:]
+            return ImmutableMatrix(rows, cols, [self.build(value) for value in args[1][1:]])
+
+        built_args = [self.build(arg) for arg in args]
+        function = self._functions.get(head)
+        if function is None:
+            # Unknown functions stay undefined
+            function = Function(head)
+        return function(*built_args)
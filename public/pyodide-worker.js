@@ -20,41 +20,173 @@ Disable cache: 17.66s, 17.19s, 13.79s, 18.70s
 36.20 MB / 23.33 MB transferred
  */
 
+const startTime = performance.now()
+/** Milliseconds that every phase of the startup took, phases can overlap */
+const timings = {}
+
 globalThis.importScripts('./pyodide/pyodide.js')
+timings.importScripts = performance.now() - startTime
+
+// Our Python modules get written to the Pyodide filesystem, so that they can import each other
+const pythonModulesPath = '/quantum-sheet'
+const pythonModules = ['mathjson.py', 'mathjson_builder.py', 'cas_cache.py', 'cas_cancellation.py', 'cas_commands.py', 'cas_numeric.py', 'cas_solver.py', 'cas_substitution.py', 'cas_session.py']
+// Results of the session get stored here, IndexedDB keeps them across reloads, see cas_cache.py
+const resultCachePath = '/quantum-sheet-cache'
+// Batches usually arrive in bursts while typing, so the result cache only gets written to IndexedDB once they stop
+const resultCacheSyncDelay = 2000
+// Fetched while Pyodide is loading
+const pythonModulesPromise = fetchPythonModules()
 
 let pyodide = undefined
+let executeCommandJson = undefined
+let flushSession = undefined
+let fetchJson = undefined
+/** @type {Promise<void> | undefined} Set while the result cache is being written to IndexedDB */
+let syncResultCache = undefined
+/** @type {ReturnType<typeof setTimeout> | undefined} */
+let syncResultCacheTimeout = undefined
+let resultCacheChanged = false
+let resultCacheOpened = false
+/**
+ * @type {Int32Array | undefined} Shared with the main thread, which writes 2 (SIGINT) into [0] to interrupt Python.
+ * [1] is the sequence number of the batch command that is running, or 0, so that the main thread only interrupts the command it cancelled
+ */
+let interruptBuffer = undefined
+/** Batch commands that got cancelled before they started */
+const cancelledIds = new Set()
+/** Batches run one after the other, even though they yield between their commands */
+let batchesDone = Promise.resolve()
 const loadPyodide = globalThis
   .loadPyodide({
     indexURL: './pyodide/',
     fullStdLib: false, // Don't load the full standard library, hopefully this doesn't cause any issues
   })
   .then(async (pyodide) => {
-    const loadPackagePromise = pyodide.loadPackage(['mpmath', 'sympy'])
-    const mathjsonPy = await fetch('./mathjson.py').then((v) => v.text())
-    await loadPackagePromise
-    pyodide.runPython('import sys\nsys.setrecursionlimit(999)\nimport sympy')
-    pyodide.runPython(mathjsonPy)
+    timings.loadPyodide = performance.now() - startTime
+    let phaseStart = performance.now()
+    await pyodide.loadPackage(['mpmath', 'sympy'])
+    timings.loadPackages = performance.now() - phaseStart
+
+    const { bundle, sources } = await pythonModulesPromise
+    pyodide.FS.mkdir(pythonModulesPath)
+    let importPath = pythonModulesPath
+    if (bundle) {
+      importPath = `${pythonModulesPath}/python-modules.zip`
+      pyodide.FS.writeFile(importPath, bundle)
+    } else {
+      pythonModules.forEach((name, i) => pyodide.FS.writeFile(`${pythonModulesPath}/${name}`, sources[i]))
+    }
+
+    phaseStart = performance.now()
+    pyodide.runPython(`import sys\nsys.setrecursionlimit(999)\nsys.path.insert(0, '${importPath}')\nimport sympy`)
+    timings.importSympy = performance.now() - phaseStart
+    phaseStart = performance.now()
+    pyodide.runPython(
+      `from mathjson import *\nfrom cas_session import session, execute_session_command_json, flush_session, fetch_json, open_result_store`
+    )
+    timings.importModules = performance.now() - phaseStart
+    if (!globalThis.crossOriginIsolated) {
+      // Without an interrupt buffer, only the deadline of the session can stop a runaway SymPy operation
+      pyodide.runPython('session.cancellation.preemptive = True')
+    }
+    phaseStart = performance.now()
+    await openResultCache(pyodide)
+    timings.openResultCache = performance.now() - phaseStart
+    executeCommandJson = pyodide.globals.get('execute_session_command_json')
+    flushSession = pyodide.globals.get('flush_session')
+    fetchJson = pyodide.globals.get('fetch_json')
+    timings.total = performance.now() - startTime
     return pyodide
   })
   .catch((error) => console.error(error))
 
+/**
+ * Fetches the bundle from utils/build-python-modules.py, which contains all Python modules in one file,
+ * or the plain Python sources one by one if there is none. Only the build output has the bundle, so the dev server uses the sources
+ * @returns {Promise<{ bundle?: Uint8Array, sources?: string[] }>}
+ */
+async function fetchPythonModules() {
+  const phaseStart = performance.now()
+  try {
+    const response = await fetch('./python-modules.zip')
+    if (response.ok) {
+      const bundle = new Uint8Array(await response.arrayBuffer())
+      // The dev server answers with index.html if there is no such file
+      if (bundle[0] == 0x50 && bundle[1] == 0x4b) {
+        return { bundle }
+      }
+    }
+    const sources = await Promise.all(pythonModules.map((name) => fetch('./' + name).then((v) => v.text())))
+    return { sources }
+  } finally {
+    timings.fetchModules = performance.now() - phaseStart
+  }
+}
+
+/**
+ * Mounts the result cache directory on IndexedDB, if Pyodide has IDBFS, and loads the stored results.
+ * Without it, the results only get cached in memory.
+ */
+async function openResultCache(pyodide) {
+  const IDBFS = pyodide.FS.filesystems?.IDBFS
+  if (!IDBFS || !globalThis.indexedDB) return
+  try {
+    pyodide.FS.mkdir(resultCachePath)
+    pyodide.FS.mount(IDBFS, {}, resultCachePath)
+    await syncFilesystem(pyodide, true)
+    // Older versions stored every result in one file
+    if (pyodide.FS.analyzePath(`${resultCachePath}/results.json`).exists) pyodide.FS.unlink(`${resultCachePath}/results.json`)
+    pyodide.globals.get('open_result_store')(`${resultCachePath}/results`)
+    resultCacheOpened = true
+  } catch (error) {
+    console.warn('Could not open the result cache', error)
+  }
+}
+
+/**
+ * @param {boolean} populate true loads from IndexedDB, false writes to it
+ */
+function syncFilesystem(pyodide, populate) {
+  return new Promise((resolve, reject) => pyodide.FS.syncfs(populate, (error) => (error ? reject(error) : resolve())))
+}
+
+/**
+ * Writes the result cache to IndexedDB a while after the last batch, at most one write is running at a time.
+ * Only the files of results that were added or evicted since the last write get stored.
+ */
+function persistResultCache() {
+  resultCacheChanged = true
+  clearTimeout(syncResultCacheTimeout)
+  syncResultCacheTimeout = setTimeout(() => {
+    syncResultCacheTimeout = undefined
+    if (syncResultCache) return
+    resultCacheChanged = false
+    syncResultCache = syncFilesystem(pyodide, false)
+      .catch((error) => console.warn('Could not store the result cache', error))
+      .finally(() => {
+        syncResultCache = undefined
+        if (resultCacheChanged) persistResultCache()
+      })
+  }, resultCacheSyncDelay)
+}
+
 if (globalThis.SharedWorkerGlobalScope) {
   globalThis.onconnect = (/**@type {MessageEvent} */ event) => {
     const messagePort = event.ports[0]
     messagePort.onmessage = function (event) {
-      messagePort.postMessage(messageHandler(event))
+      respond(event, (response, transfer) => messagePort.postMessage(response, transfer))
     }
     loadPyodide.then((v) => {
-      messagePort.postMessage({ type: 'initialized' })
+      messagePort.postMessage({ type: 'initialized', timings })
       pyodide = v
     })
   }
 } else if (globalThis.WorkerGlobalScope) {
   globalThis.onmessage = function (event) {
-    globalThis.postMessage(messageHandler(event))
+    respond(event, (response, transfer) => globalThis.postMessage(response, transfer))
   }
   loadPyodide.then((v) => {
-    globalThis.postMessage({ type: 'initialized' })
+    globalThis.postMessage({ type: 'initialized', timings })
     pyodide = v
   })
 } else {
@@ -63,14 +195,102 @@ if (globalThis.SharedWorkerGlobalScope) {
 
 /**
  *
- * @param {string[]} symbols
- * @param {string} command
+ * @param {MessageEvent} event
+ * @param {(response: WorkerResponse, transfer: Transferable[]) => void} postResponse
+ */
+function respond(event, postResponse) {
+  if (event.data?.type == 'interrupt-buffer') {
+    interruptBuffer = event.data.buffer
+    pyodide.setInterruptBuffer(interruptBuffer.subarray(0, 1))
+  } else if (event.data?.type == 'cancel') {
+    cancelledIds.add(event.data.id)
+  } else if (event.data?.type == 'mathjson-batch') {
+    batchesDone = batchesDone.then(() =>
+      batchMessageHandler(event.data).then((response) => {
+        postResponse(response, [])
+        if (response.type == 'batch' && resultCacheOpened) {
+          persistResultCache()
+        }
+      })
+    )
+  } else {
+    const response = messageHandler(event)
+    resetInterrupt()
+    postResponse(response, [])
+  }
+}
+
+/**
+ * An interrupt that arrived after Python was done must not cancel the next command
+ */
+function resetInterrupt() {
+  if (interruptBuffer) {
+    interruptBuffer[0] = 0
+  }
+}
+
+/**
+ * Executes the commands of a batch one at a time, and lets the messages that arrived in the meantime run in between.
+ * That way, a 'cancel' message skips its command if it hasn't started yet.
+ * Every command gets its own result or error, the worker only fails if the whole batch fails.
+ * The session only recomputes results whose definitions have changed.
+ * Cancelled commands return {"cancelled": "cancelled" | "timeout"}
+ * @param {WorkerMessage} message
+ * @returns {Promise<WorkerResponse>}
+ */
+async function batchMessageHandler(message) {
+  const results = []
+  try {
+    for (let i = 0; i < message.ids.length; i++) {
+      const id = message.ids[i]
+      if (cancelledIds.delete(id)) {
+        results.push('{"cancelled":"cancelled"}')
+        continue
+      }
+      if (interruptBuffer) Atomics.store(interruptBuffer, 1, message.sequences[i])
+      let result
+      try {
+        result = executeCommandJson(JSON.stringify(message.commands[i]))
+      } finally {
+        if (interruptBuffer) Atomics.store(interruptBuffer, 1, 0)
+        resetInterrupt()
+      }
+      await nextTask()
+      if (result == '{"cancelled":"cancelled"}' && !cancelledIds.delete(id)) {
+        // The main thread cancelled the previous command, which finished right before the interrupt arrived
+        i--
+        continue
+      }
+      results.push(result)
+    }
+    return {
+      type: 'batch',
+      ids: message.ids,
+      data: '[' + results.join(',') + ']',
+    }
+  } catch (e) {
+    return {
+      type: 'error',
+      ids: message.ids,
+      message: `Command ${JSON.stringify(message.commands)} resulted in an error ${e.message}`,
+    }
+  } finally {
+    flushSession()
+    // Ones that got cancelled after they were done
+    message.ids.forEach((id) => cancelledIds.delete(id))
+  }
+}
+
+const nextTaskChannel = new MessageChannel()
+
+/**
+ * Lets the messages that arrived in the meantime run, without the minimum delay of setTimeout
  */
-function wrapSympyCommand(symbols, command) {
-  const argumentNames = symbols.join(',')
-  const argumentValues = symbols.map((v) => `sympy.Symbol('${v}')`).join(',')
-  const pyCommand = `MathJsonPrinter().doprint((lambda ${argumentNames}: ${command})(${argumentValues}))`
-  return pyCommand
+function nextTask() {
+  return new Promise((resolve) => {
+    nextTaskChannel.port1.onmessage = () => resolve()
+    nextTaskChannel.port2.postMessage(undefined)
+  })
 }
 
 /**
@@ -88,8 +308,9 @@ function messageHandler(event) {
 
     if (message.type == 'python') {
       pyodideResult = pyodide.runPython(message.command)
-    } else if (message.type == 'expression') {
-      pyodideResult = pyodide.runPython(wrapSympyCommand(message.symbols, message.command))
+    } else if (message.type == 'fetch') {
+      // The contents of a placeholder in a result that was too large
+      pyodideResult = fetchJson(JSON.stringify({ command: message.command, path: message.path, index: message.index }))
     } else {
       throw new Error('Unknown command type', message)
     }
@@ -111,7 +332,8 @@ function messageHandler(event) {
     return {
       type: 'error',
       id: message.id,
-      message: `Command ${message.command} resulted in an error ${e.message}`,
+      ids: message.ids,
+      message: `Command ${JSON.stringify(message.command ?? message.commands)} resulted in an error ${e.message}`,
     }
   }
 }
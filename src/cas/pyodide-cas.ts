@@ -1,7 +1,8 @@
 import type {} from 'vite'
 import type { CasCommand } from './cas'
 import { getAllGetterNames, useEncoder } from './cas-math'
-import { Expression, format } from '@cortex-js/compute-engine'
+import { format } from '@cortex-js/compute-engine'
+import { v4 as uuidv4 } from 'uuid'
 
 export type WorkerMessage =
   | {
@@ -10,27 +11,117 @@ export type WorkerMessage =
       command: any
     }
   | {
-      type: 'expression'
+      type: 'mathjson-batch'
+      ids: string[]
+      /** Published by the worker while the command runs, see interruptBuffer */
+      sequences: number[]
+      commands: MathJsonCommand[]
+    }
+  | {
+      /** Skips a command of a batch that hasn't started yet */
+      type: 'cancel'
       id: string
-      symbols: string[]
-      command: any
+    }
+  | {
+      /** Fetches the contents of an ["Elided", ["List", ...path], size, ["List", ...index]?] placeholder */
+      type: 'fetch'
+      id: string
+      command: MathJsonCommand
+      path: number[]
+      index?: number[]
+    }
+  | {
+      /**
+       * Lets the main thread interrupt Python, see pyodide.setInterruptBuffer. [0] is the interrupt buffer,
+       * [1] is the sequence number of the batch command that is running, or 0
+       */
+      type: 'interrupt-buffer'
+      buffer: Int32Array
     }
 
+/**
+ * A command that the Python side builds and executes without generating any code, see cas_commands.py
+ */
+export interface MathJsonCommand {
+  expression: any
+  /** Encoded symbol names and their MathJson values */
+  substitutions: { [name: string]: any }
+  operation: 'evalf' | 'simplify' | 'expand' | 'factor' | 'solve' | 'rewrite'
+  argument?: string
+  /** In seconds, checked between the evaluation stages and while printing */
+  timeout?: number
+  /** Prints repeated subtrees only once, as ["Shared", ["List", ...definitions], body], see expandShared */
+  shared?: boolean
+}
+
+/**
+ * The result of a command that got cancelled or took longer than its timeout
+ */
+export class CancelledError extends Error {
+  readonly reason: 'cancelled' | 'timeout'
+
+  constructor(reason: 'cancelled' | 'timeout') {
+    super(reason == 'timeout' ? 'The command took too long' : 'The command was cancelled')
+    this.reason = reason
+  }
+}
+
 export type WorkerResponse =
   | {
       type: 'initialized'
+      /** Milliseconds that every phase of the worker startup took */
+      timings?: { [phase: string]: number }
     }
   | {
       type: 'result'
       id: string
       data: any
     }
+  | {
+      /** Every command in the batch gets either a result, an error or the reason why it got cancelled */
+      type: 'batch'
+      ids: string[]
+      data: string
+    }
   | {
       type: 'error'
-      id: string
+      id?: string
+      /** Set when a whole batch failed */
+      ids?: string[]
       message: string
     }
 
+/**
+ * Replaces the ["Ref", i] references in a ["Shared", ["List", ...definitions], body] expression with their definitions.
+ * Definitions only reference earlier definitions.
+ */
+export function expandShared(expression: any): any {
+  if (!Array.isArray(expression) || expression[0] !== 'Shared' || expression.length !== 3) {
+    return expression
+  }
+  const definitions: any[] = []
+  const replaceReferences = (value: any): any => {
+    if (!Array.isArray(value)) {
+      return value
+    } else if (value[0] === 'Ref' && value.length === 2 && typeof value[1] === 'number') {
+      return definitions[value[1]]
+    } else {
+      return value.map((v, i) => (i === 0 ? v : replaceReferences(v)))
+    }
+  }
+  expression[1].slice(1).forEach((definition: any) => definitions.push(replaceReferences(definition)))
+  return replaceReferences(expression[2])
+}
+
+/**
+ * Results with more placeholders than this show the rest of them as an ellipsis
+ */
+const maxPlaceholderFetches = 32
+
+function isPlaceholder(expression: any): boolean {
+  return Array.isArray(expression) && expression[0] === 'Elided' && Array.isArray(expression[1]) && expression[1][0] === 'List'
+}
+
 // TODO: Split out the python converter and contribute it to mathlive/cortex-js?
 function usePythonConverter() {
   const encoder = useEncoder()
@@ -53,176 +144,105 @@ function usePythonConverter() {
     return name[1] !== '_' ? name.slice(1) : encoder.decodeName(name.slice(1))
   }
 
-  function decodeNames(expression: any) {
+  // Constants which the CAS understands, every other string is a variable
+  const KnownConstants = new Set(['Pi', 'ImaginaryUnit', 'ExponentialE', 'GoldenRatio', 'EulerGamma'])
+
+  const KnownLatexFunctions = {
+    // TODO: replace with custom parser in new compute engine
+    '\\sin': 'Sin',
+    '\\cot': 'Cot',
+    '\\arcctg': 'Acot',
+  }
+
+  // The Python side builds the Sympy expression, here we only have to encode the variable names
+  function encodeNames(expression: any): any {
     if (Array.isArray(expression)) {
-      const functionName = expression[0]
+      // Function names (Add, Power, Sin, etc.) are left as they are
       const output = expression.slice()
       for (let i = 1; i < expression.length; i++) {
-        output[i] = decodeNames(expression[i])
+        output[i] = encodeNames(expression[i])
       }
       return output
     } else if (typeof expression === 'string') {
-      return expression.startsWith('_') ? decodeName(expression) : expression
+      // TODO: Handle Units here?
+      // TODO: Differentiate from variables and constants, ex: var i and imaginary i.
+      return KnownConstants.has(expression) ? expression : encodeName(expression)
+    } else if (typeof expression === 'bigint') {
+      // JSON doesn't support bigints
+      return { num: expression.toString() }
     } else {
       return expression
     }
   }
 
-  // Putting functions and constants into the same map has some pretty neat advantages.
-  // Mainly, it means that functions and constant are just different types of variables
-  const MathJsonToSympy = new Map<string, (expression: Expression[]) => string>([
-    ['Add', () => 'sympy.Add'],
-    [
-      'Subtract',
-      (v) => {
-        // a - b == a + (-b)
-        v[2] = ['Multiply', v[2], -1]
-        return 'sympy.Add'
-      },
-    ],
-    [
-      'Negate',
-      (v) => {
-        // -a == a * -1
-        v.push(-1)
-        return 'sympy.Mul'
-      },
-    ],
-    ['Multiply', () => 'sympy.Mul'],
-    [
-      'Divide',
-      (v) => {
-        // Special case for simple fractions
-        // TODO: Replace with a proper "is mathjson number" check
-        if (typeof v[1] === 'number' && typeof v[2] === 'number') {
-          // TODO: Only do this if rational numbers are enabled
-          return 'sympy.Rational'
-        } else {
-          // a / b == a * b^(-1)
-          v[2] = ['Power', v[2], -1]
-          return 'sympy.Mul'
-        }
-      },
-    ],
-    ['Power', () => 'sympy.Pow'],
-    ['Sqrt', () => 'sympy.sqrt'],
-    ['Root', () => 'sympy.root'],
-    ['EqualEqual', () => 'sympy.Eq'],
-    ['Parentheses', () => ''],
-
-    ['Abs', () => 'sympy.Abs'],
-
-    ['Sin', () => 'sympy.sin'],
-    ['Cos', () => 'sympy.cos'],
-    ['Tan', () => 'sympy.tan'],
-
-    ['Sec', () => 'sympy.sec'],
-    ['Csc', () => 'sympy.csc'],
-    ['Cot', () => 'sympy.cot'],
-
-    ['Arcsin', () => 'sympy.asin'],
-    ['Arccos', () => 'sympy.acos'],
-    ['Arctan', () => 'sympy.atan'],
-    ['Arctan2', () => 'sympy.atan2'],
-
-    ['Asec', () => 'sympy.asec'],
-    ['Acsc', () => 'sympy.acsc'],
-    ['Acot', () => 'sympy.acot'],
-
-    ['Sinh', () => 'sympy.sinh'],
-    ['Cosh', () => 'sympy.cosh'],
-    ['Tanh', () => 'sympy.tanh'],
-
-    ['Sech', () => 'sympy.sech'],
-    ['Csch', () => 'sympy.csch'],
-    ['Coth', () => 'sympy.coth'],
-
-    ['Arsinh', () => 'sympy.asinh'],
-    ['Arcosh', () => 'sympy.acosh'],
-    ['Artanh', () => 'sympy.atanh'],
-
-    ['Asech', () => 'sympy.asech'],
-    ['Acsch', () => 'sympy.acsch'],
-    ['Acoth', () => 'sympy.acoth'],
-
-    ['Pi', () => 'sympy.pi'],
-    ['ImaginaryUnit', () => 'sympy.I'], // TODO: test
-    ['ExponentialE', () => 'sympy.E'], // TODO: test
-    ['GoldenRatio', () => 'sympy.GoldenRatio'], // TODO: test
-    ['EulerGamma', () => 'sympy.EulerGamma'], // TODO: test
-    ['Gamma', () => 'sympy.gamma'], // TODO: test
-    ['LogGamma', () => 'sympy.loggamma'], // TODO: test
-    ['Erf', () => 'sympy.erf'], // TODO: test
-    ['Erfc', () => 'sympy.erfc'], // TODO: test
-
-    ['Factorial', () => 'sympy.factorial'],
-
-    // ['Equivalent', () => 'sympy.Equivalent'],
-
-    // TODO: MathLive latex serial/parse destroys ln,log, etc? in ExpressionElement.vue line 78
-    // ['log', () => 'sympy.log'],
-  ])
-
-  const KnownLatexFunctions = {
-    // TODO: replace with custom parser in new compute engine
-    '\\sin': 'sympy.sin',
-    '\\cot': 'sympy.cot',
-    '\\arcctg': 'sympy.acot',
+  // Numbers that Javascript can't represent, see MathJsonTreePrinter._integer and _float in mathjson.py
+  function decodeNumber(text: string): any {
+    if (/^[+-]?\d+$/.test(text)) {
+      return BigInt(text)
+    } else if (text === '+Infinity' || text === '-Infinity' || text === 'NaN') {
+      return Number(text)
+    }
+    // Outside of the range of doubles, e.g. 1e400 or 1.23e+100000
+    const [mantissa, exponent] = text.toLowerCase().split('e')
+    return exponent === undefined ? Number(text) : ['Multiply', Number(mantissa), ['Power', 10, Number(exponent)]]
   }
 
-  // TODO: Options (rational numbers)
-  function expressionToPython(expression: any): string {
-    if (Array.isArray(expression)) {
-      // Handle Functions (Add, Power, Sin, etc.)
-      expression = expression.slice() // Make a copy so that we can safely modify the expression
-      const functionName = expression[0]
-      const functionInPython = MathJsonToSympy.get(functionName)
-      let pythonFunctionName = functionInPython ? functionInPython(expression) : functionName
+  // ["DenseMatrix", ["Tuple", rows, cols], ["List", ...row-major values]]
+  function decodeDenseMatrix(expression: any[]): any {
+    const cols = expression[1][2]
+    const values = expression[2].slice(1)
+    const rows = []
+    for (let i = 0; i < expression[1][1]; i++) {
+      rows.push(['List', ...values.slice(i * cols, (i + 1) * cols)])
+    }
+    return ['Matrix', ['List', ...rows]]
+  }
 
-      const parameters = []
-      for (let i = 1; i < expression.length; i++) {
-        parameters.push(expressionToPython(expression[i]))
-      }
-      return `${pythonFunctionName}(${parameters.join(',')})`
-    } else if (typeof expression === 'string') {
-      const constantInPython = MathJsonToSympy.get(expression)
-      // TODO: Handle Units here?
-      // TODO: Differentiate from variables and constants, ex: var i and imaginary i.
-      if (constantInPython) {
-        // Handle Constants (pi, e, etc.)
-        return constantInPython([])
-      } else {
-        // Handle Variables
-        return encodeName(expression)
-      }
-    } else if (typeof expression === 'number') {
-      // Handle Numbers
-      if (Number.isInteger(expression)) {
-        return `sympy.Integer(${expression})`
-      } else {
-        return `sympy.Rational(${expression})`
+  // ["Polynomial", ["List", ...generators], ["List", ...exponents], ["List", ...coefficients]], the exponents of all terms one after another
+  function decodePolynomial(expression: any[]): any {
+    const generators = expression[1].slice(1)
+    const exponents = expression[2].slice(1)
+    const terms = expression[3].slice(1).map((coefficient: any, i: number) => {
+      const factors: any[] = []
+      generators.forEach((generator: any, j: number) => {
+        const exponent = exponents[i * generators.length + j]
+        if (exponent === 1) {
+          factors.push(generator)
+        } else if (exponent !== 0) {
+          factors.push(['Power', generator, exponent])
+        }
+      })
+      if (coefficient !== 1 || factors.length === 0) {
+        factors.unshift(coefficient)
       }
-    } else if (expression === null) {
-      return `None`
-    } else if (expression.num !== undefined) {
-      if (Number.isInteger(Number(expression.num))) {
-        return `sympy.Integer(${expression.num})`
-      } else {
-        return `sympy.Rational(${expression.num})`
+      return factors.length === 1 ? factors[0] : ['Multiply', ...factors]
+    })
+    return terms.length === 0 ? 0 : terms.length === 1 ? terms[0] : ['Add', ...terms]
+  }
+
+  // The Python side prints some things in a more compact way, which the renderer doesn't understand
+  function decodeResult(expression: any): any {
+    if (Array.isArray(expression)) {
+      const output = expression.map((v, i) => (i === 0 ? v : decodeResult(v)))
+      if (output[0] === 'DenseMatrix') {
+        return decodeDenseMatrix(output)
+      } else if (output[0] === 'Polynomial') {
+        return decodePolynomial(output)
       }
+      return output
+    } else if (expression !== null && typeof expression === 'object' && typeof expression.num === 'string') {
+      return decodeNumber(expression.num)
     } else {
-      // TODO: Make sure to handle all cases (string, number, bool, array, object, ...)
-      console.warn('Unknown element type', { x: expression })
-      return ''
+      return expression
     }
   }
 
   return {
     encodeName,
     decodeName,
-    decodeNames,
-    expressionToPython: (expression: any) =>
-      expressionToPython(
+    decodeResult,
+    expressionToMathJson: (expression: any) =>
+      encodeNames(
         format(expression, [
           // Sympy doesn't accept all operations https://docs.sympy.org/latest/tutorial/manipulation.html
           'canonical-subtract',
@@ -280,6 +300,7 @@ function getOrCreateWorker(): Promise<PyodideWorker> {
         }
         const workerResponse = e.data
         if (workerResponse.type == 'initialized') {
+          console.log('Worker startup timings', workerResponse.timings)
           resolve(pyodideWorker)
         } else {
           reject(`Did not receive response of type initialized. ${e.data}`)
@@ -311,6 +332,7 @@ function getOrCreateWorker(): Promise<PyodideWorker> {
 
           const workerResponse = e.data
           if (workerResponse.type == 'initialized') {
+            console.log('Worker startup timings', workerResponse.timings)
             resolve(worker)
           } else {
             reject(`Did not receive response of type initialized. ${e.data}`)
@@ -330,8 +352,22 @@ function getOrCreateWorker(): Promise<PyodideWorker> {
 export function usePyodide() {
   let worker: PyodideWorker | undefined
   const commandBuffer: WorkerMessage[] = []
-  const { encodeName, decodeNames, expressionToPython, KnownLatexFunctions } = usePythonConverter()
+  // Commands that get sent together, in a single batch
+  const pendingCommands: { id: string; command: MathJsonCommand }[] = []
+  let isBatchScheduled = false
+  // Results arrive with decoded names, the printer decodes them (see NameTable in mathjson.py)
+  const { encodeName, expressionToMathJson, decodeResult, KnownLatexFunctions } = usePythonConverter()
   const commands = new Map<string, CasCommand>()
+  // Commands that have been sent to the worker, but haven't returned yet, and their sequence numbers
+  const runningCommands = new Map<string, number>()
+  let nextSequence = 1
+  // Writing 2 (SIGINT) into [0] interrupts the worker, which writes the sequence number of the running command into [1].
+  // Only available if the page is cross origin isolated, the dev server sends the headers for that (see vite.config.js).
+  // Elsewhere, commands can only be cancelled before they start, and the session's deadline of a minute stops runaway ones (see cas_session.py)
+  const interruptBuffer =
+    typeof SharedArrayBuffer !== 'undefined' && globalThis.crossOriginIsolated ? new Int32Array(new SharedArrayBuffer(8)) : undefined
+  // Requests that return a promise instead of calling a callback
+  const requests = new Map<string, { resolve: (result: any) => void; reject: (error: Error) => void }>()
   const doneLoading = new Promise<void>((resolve, reject) => {
     getOrCreateWorker().then(
       (result) => {
@@ -344,13 +380,43 @@ export function usePyodide() {
           if (response.type == 'result') {
             console.log('Response', response)
             const command = commands.get(response.id)
-            command?.callback(decodeNames(JSON.parse(response.data)))
+            command?.callback(JSON.parse(response.data))
             commands.delete(response.id)
+            requests.get(response.id)?.resolve(JSON.parse(response.data))
+            requests.delete(response.id)
+          } else if (response.type == 'batch') {
+            console.log('Batch response', response)
+            const results: ({ result: any } | { error: string } | { cancelled: 'cancelled' | 'timeout' })[] = JSON.parse(response.data)
+            response.ids.forEach((id, i) => {
+              runningCommands.delete(id)
+              const command = commands.get(id)
+              const result = results[i]
+              if (!command) return
+              if ('cancelled' in result) {
+                command.callback(new CancelledError(result.cancelled))
+              } else if ('error' in result) {
+                command.callback(new Error(result.error))
+              } else {
+                // Stays in commands until its placeholders are fetched, so that cancelling it in the meantime drops the result
+                resolvePlaceholders(command, expandShared(result.result)).then(
+                  (expression) => commands.delete(id) && command.callback(decodeResult(expression)),
+                  (error) => commands.delete(id) && command.callback(error)
+                )
+                return
+              }
+              commands.delete(id)
+            })
           } else if (response.type == 'error') {
             console.warn(response)
-            const command = commands.get(response.id)
-            command?.callback(new Error(response.message))
-            commands.delete(response.id)
+            const ids = response.ids ?? (response.id !== undefined ? [response.id] : [])
+            ids.forEach((id) => {
+              runningCommands.delete(id)
+              const command = commands.get(id)
+              command?.callback(new Error(response.message))
+              commands.delete(id)
+              requests.get(id)?.reject(new Error(response.message))
+              requests.delete(id)
+            })
           } else {
             console.error('Unknown response type', response)
             setTimeout(() => {
@@ -372,6 +438,9 @@ export function usePyodide() {
             throw new Error('Worker Message Error')
           }, 0)
         }
+        if (interruptBuffer) {
+          worker.postMessage({ type: 'interrupt-buffer', buffer: interruptBuffer })
+        }
         resolve()
         commandBuffer.forEach((v) => sendCommand(v))
         commandBuffer.length = 0
@@ -386,20 +455,38 @@ export function usePyodide() {
   function executeCommand(command: CasCommand) {
     commands.set(command.id, command)
 
-    const getterNames = getAllGetterNames(command.expression, command.gettersData)
-    const symbolNames = Array.from(getterNames).map((key) => encodeName(key))
+    const mathJsonCommand = toMathJsonCommand(command)
+    if (!mathJsonCommand) {
+      commands.delete(command.id)
+      return
+    }
+    console.log('MathJson command', mathJsonCommand)
+    pendingCommands.push({ id: command.id, command: mathJsonCommand })
+    if (!isBatchScheduled) {
+      // Everything that gets executed in the same tick, like when a document gets loaded, ends up in one batch
+      isBatchScheduled = true
+      queueMicrotask(sendPendingCommands)
+    }
+  }
 
-    const substitutions = Array.from(command.gettersData.entries())
-      .filter(([key, _]) => getterNames.has(key)) // Only substitute those that actually appear in the expression
-      .map(([key, value]) => `${encodeName(key)}:${expressionToPython(value)}`)
-      .join(',')
+  function toMathJsonCommand(command: CasCommand): MathJsonCommand | undefined {
+    const getterNames = getAllGetterNames(command.expression, command.gettersData)
+    const substitutions: MathJsonCommand['substitutions'] = {}
+    command.gettersData.forEach((value, key) => {
+      // Only substitute those that actually appear in the expression
+      if (getterNames.has(key)) {
+        substitutions[encodeName(key)] = expressionToMathJson(value)
+      }
+    })
 
     const innerExpression = command.expression[1]
 
-    let pythonExpression = ''
+    let operation: MathJsonCommand['operation']
+    let argument: string | undefined = undefined
+    let shared: boolean | undefined = undefined
     if (command.expression[0] == 'Equal') {
       // TODO: If the expression is only a single getter or something simple, don't call the CAS
-      pythonExpression = `${expressionToPython(innerExpression)}\n\t.subs({${substitutions}})\n\t.evalf()`
+      operation = 'evalf'
     } else if (command.expression[0] == 'Evaluate') {
       let evaluation = (command.expression[2] + '').toLowerCase()
       const evaluationParameters = evaluation.match(/\\left\((.*?)\\right/)
@@ -422,61 +509,127 @@ export function usePyodide() {
           console.error('Expected one variable to solve for', variablesToSolveFor)
         }
 
-        if (Array.isArray(innerExpression) && innerExpression[0] == 'EqualEqual') {
-          // TODO: Use recommended solver instead of the generic one
-          pythonExpression = `sympy.solvers.solve(\n\t${expressionToPython(innerExpression)}\n\t\t.subs({${substitutions}})\n\t,${encodeName(
-            variablesToSolveFor[0]
-          )})`
-        } else {
+        if (!Array.isArray(innerExpression) || innerExpression[0] != 'EqualEqual') {
           console.error('Expected inner expression to be EqualEqual (==)')
         }
+        operation = 'solve'
+        argument = encodeName(variablesToSolveFor[0])
+        // The roots of cubics and quartics repeat the same large subexpressions
+        shared = true
       } else if (evaluation == 'simplify') {
-        pythonExpression = `sympy.simplify(\n\t${expressionToPython(innerExpression)}\n\t\t.subs({${substitutions}})\n)`
+        operation = 'simplify'
+        shared = true
       } else if (evaluation == '\\expand') {
-        pythonExpression = `sympy.expand(\n\t${expressionToPython(innerExpression)}\n\t\t.subs({${substitutions}})\n)`
+        operation = 'expand'
       } else if (evaluation == 'factor') {
-        pythonExpression = `sympy.factor(\n\t${expressionToPython(innerExpression)}\n\t\t.subs({${substitutions}})\n)`
-        // } else if (evaluation == 'cancel') {
-        //   pythonExpression = `sympy.cancel(\n\t${expressionToPython(innerExpression)}\n\t\t.subs({${substitutions}})\n)`
-        // } else if (evaluation == 'apart') {
-        //   pythonExpression = `sympy.apart(\n\t${expressionToPython(innerExpression)}\n\t\t.subs({${substitutions}})\n)`
-        // } else if (evaluation == 'trig_simp') {
-        //   pythonExpression = `sympy.trigsimp(\n\t${expressionToPython(innerExpression)}\n\t\t.subs({${substitutions}})\n)`
-        // } else if (evaluation == '\\expandtrig') {
-        //   pythonExpression = `sympy.expand_trig(\n\t${expressionToPython(innerExpression)}\n\t\t.subs({${substitutions}})\n)`
+        operation = 'factor'
+        // TODO: cancel, apart, trig_simp, expandtrig
       } else if (evaluation.includes('rewrite')) {
         // ex: rewrite(\\sin)
-        let using = ''
+        operation = 'rewrite'
         if (evaluationArgument && evaluationArgument in KnownLatexFunctions) {
-          using = KnownLatexFunctions[evaluationArgument]
-        } else {
-          // else: slap a 'sympy.' in front of it and attempt!?
-          if (evaluationArgument) {
-            using = 'sympy.' + evaluationArgument.replace('\\', '')
-          }
+          argument = KnownLatexFunctions[evaluationArgument]
+        } else if (evaluationArgument) {
+          // else: let sympy look it up and attempt!?
+          argument = evaluationArgument.replace('\\', '')
         }
-
-        pythonExpression = `${expressionToPython(innerExpression)}\n\t\t.subs({${substitutions}})\n\t\t.rewrite(${using})`
       } else {
-        pythonExpression = `${expressionToPython(innerExpression)}\n\t.subs({${substitutions}})\n\t.evalf()`
+        operation = 'evalf'
       }
     } else {
-      commands.delete(command.id)
-      return
+      return undefined
+    }
+
+    return {
+      expression: expressionToMathJson(innerExpression),
+      substitutions,
+      operation,
+      argument,
+      shared,
+    }
+  }
+
+  /**
+   * Results that are too large contain ["Elided", ["List", ...path], size, ["List", ...index]?] placeholders.
+   * Fetching one returns its contents, which can contain placeholders as well.
+   */
+  function fetchPlaceholder(command: CasCommand, placeholder: any[]): Promise<any> {
+    const mathJsonCommand = toMathJsonCommand(command)
+    if (!mathJsonCommand) {
+      return Promise.reject(new Error('Cannot fetch a placeholder of ' + command.expression[0]))
+    }
+    const id = uuidv4()
+    return new Promise((resolve, reject) => {
+      requests.set(id, { resolve, reject })
+      sendCommand({
+        type: 'fetch',
+        id,
+        command: mathJsonCommand,
+        path: placeholder[1].slice(1),
+        index: placeholder[3]?.slice(1),
+      })
+    })
+  }
+
+  /**
+   * Replaces the placeholders in a result with their contents, until there are none left or maxPlaceholderFetches is reached.
+   * The contents of the rest of a list are a ["Sequence", ...], which gets spliced into the list.
+   */
+  async function resolvePlaceholders(command: CasCommand, expression: any): Promise<any> {
+    let fetches = 0
+    const resolveValue = async (value: any): Promise<any> => {
+      if (isPlaceholder(value)) {
+        if (fetches >= maxPlaceholderFetches) {
+          return ['Text', { str: '...' }]
+        }
+        fetches += 1
+        return resolveValue(await fetchPlaceholder(command, value))
+      } else if (!Array.isArray(value)) {
+        return value
+      }
+      const output = [value[0]]
+      for (let i = 1; i < value.length; i++) {
+        const resolved = await resolveValue(value[i])
+        if (isPlaceholder(value[i]) && value[i].length > 3 && Array.isArray(resolved) && resolved[0] === 'Sequence') {
+          output.push(...resolved.slice(1))
+        } else {
+          output.push(resolved)
+        }
+      }
+      return output
     }
+    return resolveValue(expression)
+  }
 
-    console.log('Python expression', pythonExpression, ' symbols', symbolNames)
+  function sendPendingCommands() {
+    isBatchScheduled = false
+    // Cancelled commands don't need to be sent
+    const batch = pendingCommands.filter((v) => commands.has(v.id))
+    pendingCommands.length = 0
+    if (batch.length === 0) return
+
+    const sequences = batch.map((v) => {
+      const sequence = nextSequence
+      nextSequence = nextSequence >= 0x7fffffff ? 1 : nextSequence + 1
+      runningCommands.set(v.id, sequence)
+      return sequence
+    })
     sendCommand({
-      type: 'expression',
-      id: command.id,
-      symbols: symbolNames,
-      command: pythonExpression,
+      type: 'mathjson-batch',
+      ids: batch.map((v) => v.id),
+      sequences,
+      commands: batch.map((v) => v.command),
     })
   }
 
   function cancelCommand(command: CasCommand) {
-    if (commands.delete(command.id)) {
-      // TODO: Interrupt worker
+    const sequence = runningCommands.get(command.id)
+    if (!commands.delete(command.id) || sequence === undefined) return
+    // Commands that haven't been sent yet get filtered out by sendPendingCommands. The worker skips the ones that haven't started yet
+    sendCommand({ type: 'cancel', id: command.id })
+    if (interruptBuffer && Atomics.load(interruptBuffer, 1) === sequence) {
+      // Only interrupts this command. If it finishes in the meantime, the worker executes the next one again
+      Atomics.store(interruptBuffer, 0, 2)
     }
   }
 
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The Python modules of the worker live in public/, next to pyodide-worker.js
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'public'))
@@ -0,0 +1,48 @@
+from cas_cache import FileResultStore, MemoryResultStore, fingerprint
+
+
+def test_results_survive_reopening(tmp_path):
+    store = FileResultStore(str(tmp_path), version="a")
+    store.put("key", '["Add",1,2]')
+    store.flush()
+    assert FileResultStore(str(tmp_path), version="a").get("key") == '["Add",1,2]'
+
+
+def test_other_version_discards_results(tmp_path):
+    store = FileResultStore(str(tmp_path), version="a")
+    store.put("key", "1")
+    store.flush()
+    reopened = FileResultStore(str(tmp_path), version="b")
+    assert reopened.get("key") is None
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["version"]
+    # And the old version doesn't get them back either
+    assert FileResultStore(str(tmp_path), version="a").get("key") is None
+
+
+def test_unflushed_results_are_not_stored(tmp_path):
+    store = FileResultStore(str(tmp_path), version="a")
+    store.put("key", "1")
+    assert FileResultStore(str(tmp_path), version="a").get("key") is None
+
+
+def test_evicted_results_get_deleted(tmp_path):
+    store = FileResultStore(str(tmp_path), max_entries=2, version="a")
+    for key in ("a", "b", "c"):
+        store.put(key, key)
+    store.flush()
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["b", "c", "version"]
+
+
+def test_memory_store_evicts_least_recently_used():
+    store = MemoryResultStore(max_entries=2)
+    store.put("a", "1")
+    store.put("b", "2")
+    store.get("a")
+    store.put("c", "3")
+    assert store.get("b") is None
+    assert store.get("a") == "1"
+
+
+def test_fingerprint_ignores_key_order():
+    assert fingerprint({"a": 1, "b": 2}) == fingerprint({"b": 2, "a": 1})
+    assert fingerprint({"a": 1}) != fingerprint({"a": 2})
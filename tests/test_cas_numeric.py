@@ -0,0 +1,60 @@
+import pytest
+from sympy import Float, I, Integer, Rational, Symbol, atan, cos, exp, log, pi, sin, sqrt, zoo
+
+from cas_numeric import NumericEngine
+
+x = Symbol('x')
+y = Symbol('y')
+
+values = {x: Rational(3, 7), y: Float('2.5')}
+
+
+@pytest.mark.parametrize("expr", [
+    x + y,
+    x ** 2 * y - 3,
+    sin(x) * exp(y) + cos(pi * x),
+    sqrt(y) / (1 + x),
+    log(y) * atan(x),
+], ids=str)
+@pytest.mark.parametrize("mode", ["mpmath", "float64"])
+def test_evaluate_matches_evalf(expr, mode):
+    expected = expr.subs(values).evalf(15)
+    result = NumericEngine(mode).evaluate(expr, values)
+    tolerance = 1e-13 if mode == "mpmath" else 1e-9
+    assert abs(complex(result) - complex(expected)) <= tolerance * max(1, abs(complex(expected)))
+
+
+def test_evaluate_complex():
+    result = NumericEngine().evaluate(exp(I * x) * y, values)
+    assert abs(complex(result) - complex(exp(I * x).subs(values).evalf(15) * values[y])) < 1e-13
+    # The math module only has real functions, so evalf has to do it
+    assert NumericEngine("float64").evaluate(exp(I * x), values) is None
+
+
+def test_evaluate_with_more_digits():
+    expr = sin(x) * pi
+    result = NumericEngine().evaluate(expr, {x: Rational(1, 3)}, dps=30)
+    assert abs(result - expr.subs(x, Rational(1, 3)).evalf(30)) < Float('1e-29', 30)
+
+
+def test_evaluate_declines_cancellation():
+    # Almost all digits cancel, so the two precisions of _evaluate_mpmath disagree and evalf has to do it
+    expr = (x - Rational(3, 7) + Float('1e-12')) * y
+    assert NumericEngine().evaluate(expr, values) is None
+
+
+def test_evaluate_missing_values():
+    assert NumericEngine().evaluate(x + y, {x: 1}) is None
+
+
+def test_evaluate_pole():
+    assert NumericEngine().evaluate(1 / x, {x: Integer(0)}) is None
+    assert (1 / x).subs(x, 0) == zoo
+
+
+def test_changing_values_reuses_the_compiled_function():
+    engine = NumericEngine()
+    for value in range(5):
+        engine.evaluate(sin(x) + x ** 2, {x: Integer(value)})
+    assert engine.misses == 1
+    assert engine.hits == 4
@@ -0,0 +1,56 @@
+import pytest
+from sympy import Abs, Eq, Rational, Symbol, cos, exp, solve, sqrt
+
+from cas_solver import NumericRoots, Solver
+from mathjson import MathJsonTreePrinter
+
+x = Symbol('x')
+a = Symbol('a')
+
+
+@pytest.mark.parametrize("equation, strategy", [
+    (2 * x + 3, "linear"),
+    (Eq(a * x, 1), "linear"),
+    (x ** 2 - 5 * x + 6, "polynomial"),
+    (x ** 2 + 1, "polynomial"),
+    (x ** 3 - 2 * x ** 2 - x + 2, "polynomial"),
+    (x ** 4 - 5 * x ** 2 + 4, "polynomial"),
+    (x ** 3 - x - 1, "polynomial"),
+    (x ** 2 - a, "polynomial"),
+    (exp(x) - 2, "symbolic"),
+    (sqrt(x) - 3, "symbolic"),
+], ids=str)
+def test_roots_are_ordered_like_solve(equation, strategy):
+    solutions, used_strategy = Solver().solve(equation, x)
+    assert used_strategy == strategy
+    assert solutions == solve(equation, x)
+
+
+def test_symbols_with_assumptions_use_solve():
+    positive = Symbol('p', positive=True)
+    assert Solver().solve(positive ** 2 - 4, positive) == ([2], "symbolic")
+
+
+def test_numeric_roots_satisfy_the_equation():
+    solutions, strategy = Solver().solve(cos(x) - x, x)
+    assert strategy == "numeric"
+    assert len(solutions) == 1
+    assert abs(cos(solutions[0]) - solutions[0]) < 1e-12
+
+
+def test_numeric_roots_of_real_equations_are_real():
+    with pytest.raises(NotImplementedError):
+        solve(Abs(x) - 1, x)
+    solutions, strategy = Solver().solve(Abs(x) - 1, x)
+    assert strategy == "numeric"
+    assert sorted(solutions) == [-1, 1]
+
+
+def test_numeric_roots_are_printed_as_partial():
+    tree = MathJsonTreePrinter().totree(NumericRoots(Rational(1), Rational(-1)))
+    assert tree == ["NumericRoots", 1, -1]
+
+
+def test_unsolvable_equation_with_other_symbols():
+    with pytest.raises(ValueError):
+        Solver().solve(Abs(x) - a, x)
@@ -0,0 +1,114 @@
+import json
+
+import pytest
+from sympy import Add, Eq, Float, Integer, Matrix, Poly, Rational, Symbol, cos, exp, factorial, pi, sin, sqrt
+
+from mathjson import MathJsonPrinter, MathJsonStreamWriter, MathJsonTreePrinter, expand_shared
+from mathjson_builder import MathJsonBuilder
+
+x = Symbol('_x')
+y = Symbol('_y')
+
+expressions = [
+    Integer(3),
+    Integer(-7),
+    Rational(2, 3),
+    Float('1.5'),
+    factorial(30),
+    x,
+    x + 2 * y,
+    x ** 2 - 3 * x * y + Rational(1, 2),
+    sin(x) ** 2 + cos(x) ** 2,
+    exp(-x / 3) * sqrt(x + pi),
+    Eq(x ** 2, 4),
+    Matrix([[1, 2], [3, 4]]),
+    Matrix([[x, 1], [0, y]]),
+    Poly(3 * x ** 2 + x * y - 2, x, y),
+]
+
+
+def elided(tree):
+    return isinstance(tree, list) and len(tree) >= 3 and tree[0] == "Elided" and isinstance(tree[1], list)
+
+
+def resolve(writer, expr, tree):
+    """
+    Replaces the placeholders of a tree with their contents, like the frontend does
+    """
+    if elided(tree):
+        return resolve(writer, expr, json.loads(writer.fetch(expr, tree[1][1:], tree[3][1:] if len(tree) > 3 else None)))
+    if not isinstance(tree, list):
+        return tree
+    output = [tree[0]]
+    for item in tree[1:]:
+        resolved = resolve(writer, expr, item)
+        if elided(item) and len(item) > 3:
+            output.extend(resolved[1:])
+        else:
+            output.append(resolved)
+    return output
+
+
+@pytest.mark.parametrize("expr", expressions, ids=str)
+def test_string_and_tree_output_match(expr):
+    assert json.loads(MathJsonPrinter().doprint(expr)) == MathJsonTreePrinter().totree(expr)
+
+
+@pytest.mark.parametrize("expr", [e for e in expressions if not isinstance(e, (Matrix, Poly))], ids=str)
+def test_builder_round_trip(expr):
+    tree = MathJsonTreePrinter().totree(expr)
+    assert MathJsonBuilder().build(tree) == expr
+
+
+def test_builder_round_trip_polynomial():
+    expr = Poly(3 * x ** 2 + x * y - 2, x, y)
+    assert MathJsonBuilder().build(MathJsonTreePrinter().totree(expr)) == expr.as_expr()
+
+
+def test_shared_subtrees_expand_to_the_same_tree():
+    common = sqrt(x ** 2 + y ** 2 + 1)
+    expr = (common + 1) / (common - x) + sin(common) * common
+    shared = MathJsonTreePrinter({"shared_subtrees": True}).totree(expr)
+    assert shared[0] == "Shared"
+    assert expand_shared(shared) == MathJsonTreePrinter().totree(expr)
+
+
+def test_shared_subtrees_without_repetition():
+    expr = x + 2 * y
+    assert MathJsonTreePrinter({"shared_subtrees": True}).totree(expr) == MathJsonTreePrinter().totree(expr)
+
+
+def test_stream_writer_without_budget():
+    expr = sin(x) ** 2 + exp(y)
+    assert MathJsonStreamWriter().dumps(expr) == MathJsonTreePrinter().doprint(expr)
+
+
+@pytest.mark.parametrize("expr", [
+    Add(*[sin(i * x) ** (i % 5 + 1) * Integer(10) ** (i * 3) for i in range(1, 13)], evaluate=False),
+    Matrix([[i * x for i in range(1, 40)]]),
+], ids=["add", "matrix"])
+def test_placeholders_fetch_the_whole_tree(expr):
+    writer = MathJsonStreamWriter(max_nodes=30)
+    tree = json.loads(writer.dumps(expr))
+    assert writer.elided > 0
+    assert resolve(writer, expr, tree) == MathJsonTreePrinter().totree(expr)
+
+
+def test_placeholders_for_the_rest_of_a_list():
+    items = [Integer(i) for i in range(1, 200)]
+    writer = MathJsonStreamWriter(max_nodes=30)
+    tree = json.loads(writer.dumps(items))
+    assert elided(tree[-1]) and len(tree[-1]) == 4
+    assert resolve(writer, items, tree) == MathJsonTreePrinter().totree(items)
+
+
+def test_deep_tree_prints_iteratively():
+    expr = x
+    for i in range(3000):
+        expr = sin(Add(expr, i, evaluate=False), evaluate=False)
+    with pytest.raises(RecursionError):
+        MathJsonTreePrinter().doprint(expr)
+    printer = MathJsonTreePrinter({"iterative": True})
+    text = printer.doprint(expr)
+    assert text.startswith('["Sin",["Add",')
+    assert text.count('"Sin"') == 3000
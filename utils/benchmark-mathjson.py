@@ -0,0 +1,192 @@
+"""
+Benchmarks the MathJson printer under desktop CPython, with the same SymPy version as Pyodide.
+
+    python utils/benchmark-mathjson.py --output bench.json
+    python utils/benchmark-mathjson.py --compare bench.json
+
+Every workload gets printed a few times, the fastest run counts. Peak memory gets measured
+in a separate run, since tracemalloc slows everything down.
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'public'))
+
+import sympy
+from sympy import Add, Float, ImmutableMatrix, Matrix, Symbol, cos, exp, expand, factorial, log, sin, symbols, tan
+
+from mathjson import MathJsonPrinter, MathJsonTreePrinter, _subtree_children
+
+
+def wide_add():
+    x, y, z = symbols('x y z')
+    return expand((x + y + z + 1) ** 14)
+
+
+def deep_pow_mul():
+    x, y = symbols('x y')
+    expr = x
+    for i in range(120):
+        expr = y / (1 + expr ** 2) * (i + 2)
+    return expr
+
+
+def evalf_floats():
+    x, y = symbols('x y')
+    return expand((1.1 * x + 2.3 * y + 0.7) ** 25).evalf()
+
+
+def big_integers():
+    x = Symbol('x')
+    return expand((x + 10 ** 40) ** 40) + factorial(3000) * x
+
+
+def numeric_matrix():
+    generator = random.Random(0)
+    return ImmutableMatrix(200, 200, [Float(generator.random()) for _ in range(200 * 200)])
+
+
+def symbolic_matrix():
+    x, y = symbols('x y')
+    return Matrix(30, 30, lambda i, j: x ** i + y * j - i * j)
+
+
+def trig():
+    x, y = symbols('x y')
+    return Add(*[
+        sin(i * x) * cos(j * y) + tan(x + i) / exp(j * y) + log(i + j * x)
+        for i in range(1, 20) for j in range(1, 10)
+    ])
+
+
+workloads = {
+    "wide_add": wide_add,
+    "deep_pow_mul": deep_pow_mul,
+    "evalf_floats": evalf_floats,
+    "big_integers": big_integers,
+    "numeric_matrix": numeric_matrix,
+    "symbolic_matrix": symbolic_matrix,
+    "trig": trig,
+}
+
+
+def count_nodes(expr):
+    count = 0
+    stack = [expr]
+    while stack:
+        node = stack.pop()
+        count += 1
+        stack.extend(_subtree_children(node))
+    return count
+
+
+def measure(printer_class, settings, expr, repeat):
+    times = []
+    for _ in range(repeat):
+        printer = printer_class(settings)
+        start = time.perf_counter()
+        output = printer.doprint(expr)
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        printer_class(settings).doprint(expr)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    if not isinstance(output, str):
+        output = json.dumps(output, separators=(',', ':'))
+    return min(times), peak, len(output)
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, max_slowdown):
+    """
+    Prints the relative speed of every workload and returns the ones that got slower than max_slowdown
+    """
+    regressions = []
+    baseline_results = {result["name"]: result for result in baseline["results"]}
+    for result in results:
+        old = baseline_results.get(result["name"])
+        if old is None:
+            continue
+        slowdown = result["seconds"] / old["seconds"]
+        print("%-16s %6.2fx time  %6.2fx memory" % (result["name"], slowdown, result["peak_bytes"] / max(old["peak_bytes"], 1)))
+        if slowdown > max_slowdown:
+            regressions.append(result["name"])
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the MathJson printer")
+    parser.add_argument("--output", help="Writes the results as JSON to this file")
+    parser.add_argument("--compare", help="Compares the results with an earlier JSON file")
+    parser.add_argument("--max-slowdown", type=float, default=1.25, help="Fails if a workload got this much slower than in --compare")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--printer", choices=["tree", "string"], default="tree")
+    parser.add_argument("--recursive", action="store_true", help="Uses the recursive instead of the iterative printer")
+    parser.add_argument("--ordering", choices=["canonical", "fast", "none"], default="canonical")
+    parser.add_argument("workloads", nargs="*", help="Any of %s, defaults to all of them" % ", ".join(workloads))
+    args = parser.parse_args()
+    unknown = [name for name in args.workloads if name not in workloads]
+    if unknown:
+        parser.error("Unknown workloads %s" % ", ".join(unknown))
+
+    printer_class = MathJsonTreePrinter if args.printer == "tree" else MathJsonPrinter
+    # Without a print cache, since every repetition would hit it
+    settings = {"iterative": not args.recursive, "ordering": args.ordering}
+    results = []
+    for name in args.workloads or list(workloads):
+        expr = workloads[name]()
+        nodes = count_nodes(expr)
+        seconds, peak, output_bytes = measure(printer_class, settings, expr, args.repeat)
+        results.append({
+            "name": name,
+            "nodes": nodes,
+            "seconds": seconds,
+            "nodes_per_second": nodes / seconds,
+            "peak_bytes": peak,
+            "output_bytes": output_bytes,
+        })
+        print("%-16s %8d nodes %9.4f s %12.0f nodes/s %10.1f KiB peak" % (name, nodes, seconds, nodes / seconds, peak / 1024))
+
+    report = {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "sympy": sympy.__version__,
+        "printer": printer_class.__name__,
+        "settings": settings,
+        "repeat": args.repeat,
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+        regressions = compare(results, baseline, args.max_slowdown)
+        if regressions:
+            print("Slower than %.2fx: %s" % (args.max_slowdown, ", ".join(regressions)))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,37 @@
+"""
+Bundles the Python modules of the worker into dist/python-modules.zip, so that the worker only has to fetch
+one file instead of one per module.
+
+    python utils/build-python-modules.py
+
+npm run build and npm run deploy run this after vite build. The zip only goes into the build output, the dev server
+doesn't have it and serves the plain sources from public/ instead, so edits to them take effect immediately.
+
+The zip only has the sources. Bytecode only works with the Python version that compiled it, and nothing here knows which
+Python version the downloaded Pyodide has, so Pyodide compiles them itself.
+"""
+
+import argparse
+import os
+import zipfile
+
+public_directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'public')
+dist_directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'dist')
+
+# Same as in pyodide-worker.js
+python_modules = ['mathjson.py', 'mathjson_builder.py', 'cas_cache.py', 'cas_cancellation.py', 'cas_commands.py', 'cas_numeric.py', 'cas_solver.py', 'cas_substitution.py', 'cas_session.py']
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bundles the Python modules of the worker")
+    parser.add_argument("--output", default=os.path.join(dist_directory, 'python-modules.zip'))
+    args = parser.parse_args()
+
+    with zipfile.ZipFile(args.output, 'w', zipfile.ZIP_DEFLATED) as bundle:
+        for name in python_modules:
+            bundle.write(os.path.join(public_directory, name), name)
+    print("Wrote %s" % args.output)
+
+
+if __name__ == "__main__":
+    main()
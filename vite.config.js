@@ -3,5 +3,13 @@ import vue from '@vitejs/plugin-vue'
 
 // https://vitejs.dev/config/
 export default defineConfig({
-  plugins: [vue()]
+  plugins: [vue()],
+  server: {
+    // Cross origin isolation enables SharedArrayBuffer, which cancelCommand needs to interrupt the Pyodide worker
+    // GitHub Pages can't set these headers, so the deployed page relies on the deadline of the Python session instead
+    headers: {
+      'Cross-Origin-Opener-Policy': 'same-origin',
+      'Cross-Origin-Embedder-Policy': 'require-corp',
+    },
+  },
 })
\ No newline at end of file